@@ -0,0 +1,173 @@
+import os                                     # data access
+import json                                   # JSON encoder and decoder
+import math                                   # tolerance growth
+from zipfile import ZipFile                   # KMZ archives
+from osgeo import ogr, osr, gdal              # geometry parsing and clipping
+from cache import cache_key, file_checksum
+
+# AOI loader: reads GeoJSON, SHP, KML and KMZ in memory (no converted files are written next to the AOI)
+# and returns the exact geometry for clipping the flood mask plus a simplified footprint with at most
+# max_vertices vertices, which drives the hub query and the SNAP Subset. Parsed AOIs are cached by content hash.
+
+# AOI file types in order of preference
+aoi_extensions = ['.geojson', '.json', '.shp', '.kml', '.kmz']
+
+# default vertex limit of the search and subset footprint
+max_vertices = 250
+
+# parsed AOIs of this process by content hash
+parsed_aois = {}
+
+# single AOI file of folder, FileNotFoundError if there is none
+def find_aoi_file(path):
+    names = os.listdir(path) if os.path.isdir(path) else []
+    for extension in aoi_extensions:
+        files = [name for name in names if name.lower().endswith(extension)]
+        if len(files) == 1:
+            return os.path.join(path, files[0])
+    raise FileNotFoundError('No AOI file found in %s.' % path)
+
+# GDAL path of AOI file, KML inside KMZ archives is read through /vsizip/
+def vector_path(file):
+    if not file.lower().endswith('.kmz'):
+        return file
+    with ZipFile(file, 'r') as kmz:
+        kml = [name for name in kmz.namelist() if name.lower().endswith('.kml')]
+    if len(kml) != 1:
+        raise FileNotFoundError('KMZ file %s does not contain exactly one KML file.' % file)
+    return '/vsizip/%s/%s' % (file, kml[0])
+
+# all files of AOI, shapefiles come with sidecar files of the same name
+def aoi_files(file):
+    if not file.lower().endswith('.shp'):
+        return [file]
+    stem = os.path.splitext(os.path.basename(file))[0]
+    path = os.path.dirname(file)
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if os.path.splitext(name)[0] == stem)
+
+# GeoJSON FeatureCollection in WGS84 of all features of AOI file
+def read_features(file):
+    if file.lower().endswith(('.geojson', '.json')):
+        with open(file, 'r') as f:
+            data_json = json.load(f)
+        if data_json.get('type') == 'FeatureCollection':
+            return data_json
+        if data_json.get('type') == 'Feature':
+            return {'type': 'FeatureCollection', 'features': [data_json]}
+        return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': {}, 'geometry': data_json}]}
+    datasource = ogr.Open(vector_path(file))
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    features = []
+    for i in range(datasource.GetLayerCount()):
+        layer = datasource.GetLayer(i)
+        transform = None
+        if layer.GetSpatialRef() is not None and not layer.GetSpatialRef().IsSame(wgs84):
+            transform = osr.CoordinateTransformation(layer.GetSpatialRef(), wgs84)
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+            if transform is not None:
+                geom.Transform(transform)
+            features.append({'type': 'Feature', 'properties': {}, 'geometry': json.loads(geom.ExportToJson())})
+    return {'type': 'FeatureCollection', 'features': features}
+
+# union of the polygons of all features, 2D
+def union_geometry(data_json):
+    union = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feature in data_json['features']:
+        # features without geometry are skipped, as in read_features
+        if feature.get('geometry') is None:
+            continue
+        geom = ogr.CreateGeometryFromJson(json.dumps(feature['geometry']))
+        geom.FlattenTo2D()
+        # KML MultiGeometry is read as geometry collection
+        if geom.GetGeometryType() in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+            parts = [geom.GetGeometryRef(i) for i in range(geom.GetGeometryCount())]
+        else:
+            parts = [geom]
+        for part in parts:
+            if part.GetGeometryType() == ogr.wkbPolygon:
+                union.AddGeometry(part)
+    if union.IsEmpty():
+        raise ValueError('AOI contains no polygons.')
+    return union.UnionCascaded()
+
+def count_points(geom):
+    if geom.GetGeometryCount() == 0:
+        return geom.GetPointCount()
+    return sum(count_points(geom.GetGeometryRef(i)) for i in range(geom.GetGeometryCount()))
+
+# single polygon containing geom with at most max_vertices vertices
+# buffering by the tolerance first keeps the simplified outline outside of the exact one
+def simplify_footprint(geom, max_vertices=max_vertices):
+    minx, maxx, miny, maxy = geom.GetEnvelope()
+    tolerance = math.hypot(maxx - minx, maxy - miny) / 10000
+    footprint = geom
+    while True:
+        if footprint.GetGeometryType() != ogr.wkbPolygon:
+            # Subset needs a single polygon
+            footprint = footprint.ConvexHull()
+        if count_points(footprint) <= max_vertices:
+            return footprint
+        footprint = geom.Buffer(tolerance, 1).SimplifyPreserveTopology(tolerance)
+        tolerance *= 2
+
+# load AOI of folder: {'geojson': FeatureCollection for maps, 'exact': WKT, 'footprint': simplified WKT}
+# cache_dir: optional folder where parsed AOIs are kept across runs
+def load_aoi(path, cache_dir=None, max_vertices=max_vertices):
+    file = find_aoi_file(path)
+    key = cache_key('aoi', [file_checksum(part) for part in aoi_files(file)], max_vertices)
+    if key in parsed_aois:
+        return parsed_aois[key]
+    cache_file = os.path.join(cache_dir, '%s.json' % key) if cache_dir else None
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            parsed_aois[key] = json.load(f)
+        return parsed_aois[key]
+
+    data_json = read_features(file)
+    exact = union_geometry(data_json)
+    footprint = simplify_footprint(exact, max_vertices)
+    aoi = {'geojson': data_json, 'exact': exact.ExportToWkt(), 'footprint': footprint.ExportToWkt()}
+    print('AOI %s: %d vertices, footprint %d vertices.' % (os.path.basename(file), count_points(exact), count_points(footprint)), flush=True)
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump(aoi, f)
+        os.replace(cache_file + '.tmp', cache_file)
+    parsed_aois[key] = aoi
+    return aoi
+
+# in-memory layer of the exact AOI (WKT, WGS84) transformed into projection (WKT), e.g. for rasterizing it
+def aoi_layer(exact, projection):
+    geom = ogr.CreateGeometryFromWkt(exact)
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(projection)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if not srs.IsSame(wgs84):
+        geom.Transform(osr.CoordinateTransformation(wgs84, srs))
+    vector = ogr.GetDriverByName('Memory').CreateDataSource('aoi')
+    layer = vector.CreateLayer('aoi', srs=srs, geom_type=ogr.wkbMultiPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geom)
+    layer.CreateFeature(feature)
+    return vector, layer
+
+# set pixels of every band of in-memory mask dataset outside of the exact AOI (WKT, WGS84) to 0
+def clip_to_aoi(mask_image, exact):
+    vector, layer = aoi_layer(exact, mask_image.GetProjectionRef())
+    inside_image = gdal.GetDriverByName('MEM').Create('', mask_image.RasterXSize, mask_image.RasterYSize, 1, gdal.GDT_Byte)
+    inside_image.SetGeoTransform(mask_image.GetGeoTransform())
+    inside_image.SetProjection(mask_image.GetProjectionRef())
+    gdal.RasterizeLayer(inside_image, [1], layer, burn_values=[1])
+    inside = inside_image.GetRasterBand(1).ReadAsArray()
+    for i in range(mask_image.RasterCount):
+        mask_band = mask_image.GetRasterBand(i + 1)
+        mask_band.WriteArray(mask_band.ReadAsArray() * inside)
+    return mask_image
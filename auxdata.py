@@ -0,0 +1,174 @@
+import os                                     # data access
+import sys
+import math                                   # tile grid computation
+import argparse                               # command line interface
+import zipfile                                # archived tiles
+import requests                               # HTTP downloads
+from osgeo import ogr, gdal                   # clipping and mosaicking
+from cache import cache_key
+from downloadimage import download_file
+
+# Local store of the auxiliary data which SNAP otherwise downloads on first use: SRTM 1Sec DEM tiles for
+# Terrain-Correction and GlobCover for AddLandCover. 'prewarm' fetches everything for a region ahead of time,
+# runs then use per-AOI clips from the store, offline runs fail early if something is missing.
+#
+# <aux_dir>/dem/SRTMGL1/N52E005.hgt       1x1 degree DEM tiles (a .missing marker for tiles over sea)
+# <aux_dir>/landcover/GlobCover.tif       global GlobCover map
+# <aux_dir>/aoi/<key>/dem.tif             DEM clipped to AOI, reused across runs
+# <aux_dir>/aoi/<key>/GlobCover.tif       GlobCover clipped to AOI
+# Usage: python auxdata.py prewarm --aoi AOI/aoi.geojson   or   python auxdata.py prewarm --bounds 4.5 51.5 6.5 53.0
+
+# sources of the auxiliary data (the same SNAP downloads from), can be pointed to a mirror
+aux_sources = {
+    'dem'       : 'https://step.esa.int/auxdata/dem/SRTMGL1/%s.SRTMGL1.hgt.zip',
+    'landcover' : 'https://step.esa.int/auxdata/landcover/globcover/GLOBCOVER_L4_200901_200912_V2.3.color.tif.zip'
+}
+
+# no-data value of SRTM heights, also used for the clipped DEM
+dem_no_data = -32768
+
+# margin in degrees around the AOI, Terrain-Correction needs DEM values slightly outside of the footprint
+aux_margin = 0.05
+
+# pixel size in degrees of the sea-level DEM of AOIs without SRTM tiles (3 arc seconds)
+sea_level_resolution = 1 / 1200.0
+
+# names of SRTM tiles covering bounds (minx, miny, maxx, maxy), named after their south-west corner
+def srtm_tile_names(bounds):
+    minx, miny, maxx, maxy = bounds
+    names = []
+    for lat in range(math.floor(miny), math.ceil(maxy)):
+        for lon in range(math.floor(minx), math.ceil(maxx)):
+            names.append('%s%02d%s%03d' % ('N' if lat >= 0 else 'S', abs(lat), 'E' if lon >= 0 else 'W', abs(lon)))
+    return names
+
+# download url into file, extracting the first file ending in 'extension' from zip archives
+def fetch(session, url, file, extension):
+    download = file + '.download'
+    download_file(session, url, download, connections=1)
+    if zipfile.is_zipfile(download):
+        with zipfile.ZipFile(download) as archive:
+            member = [name for name in archive.namelist() if name.lower().endswith(extension)][0]
+            with archive.open(member) as source, open(file + '.tmp', 'wb') as target:
+                for chunk in iter(lambda: source.read(1024**2), b''):
+                    target.write(chunk)
+        os.remove(download)
+        os.replace(file + '.tmp', file)
+    else:
+        os.replace(download, file)
+    return file
+
+# DEM tiles of bounds from the store, missing tiles are downloaded unless offline
+def get_dem_tiles(bounds, aux_dir, offline=False, session=None):
+    tile_path = os.path.join(aux_dir, 'dem', 'SRTMGL1')
+    os.makedirs(tile_path, exist_ok=True)
+    tiles = []
+    for name in srtm_tile_names(bounds):
+        file = os.path.join(tile_path, '%s.hgt' % name)
+        if os.path.isfile(file):
+            tiles.append(file)
+            continue
+        if os.path.isfile(file + '.missing'):
+            continue
+        if offline:
+            raise FileNotFoundError('DEM tile %s is not in the aux-data store, run auxdata.py prewarm first.' % name)
+        session = session or requests.Session()
+        try:
+            tiles.append(fetch(session, aux_sources['dem'] % name, file, '.hgt'))
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            # SRTM has no tiles over sea
+            open(file + '.missing', 'w').close()
+    return tiles
+
+def get_landcover(aux_dir, offline=False, session=None):
+    file = os.path.join(aux_dir, 'landcover', 'GlobCover.tif')
+    if os.path.isfile(file):
+        return file
+    if offline:
+        raise FileNotFoundError('GlobCover is not in the aux-data store, run auxdata.py prewarm first.')
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    print('Downloading GlobCover...', flush=True)
+    return fetch(session or requests.Session(), aux_sources['landcover'], file, '.tif')
+
+# fetch DEM tiles and GlobCover for bounds (minx, miny, maxx, maxy) into the store
+def prewarm(bounds, aux_dir):
+    session = requests.Session()
+    tiles = get_dem_tiles(bounds, aux_dir, session=session)
+    landcover = get_landcover(aux_dir, session=session)
+    print('Aux-data store %s holds %d DEM tiles for the region and %s.' % (aux_dir, len(tiles), os.path.basename(landcover)), flush=True)
+    return tiles, landcover
+
+# bounds of all features of a vector file (GeoJSON, SHP, KML)
+def vector_bounds(file):
+    datasource = ogr.Open(file)
+    envelopes = [datasource.GetLayer(i).GetExtent() for i in range(datasource.GetLayerCount())]
+    return (min(e[0] for e in envelopes), min(e[2] for e in envelopes), max(e[1] for e in envelopes), max(e[3] for e in envelopes))
+
+# constant 0 m DEM covering bounds, heights are relative to the geoid like SRTM
+def sea_level_dem(file, bounds):
+    minx, miny, maxx, maxy = bounds
+    w = max(1, int(math.ceil((maxx - minx) / sea_level_resolution)))
+    h = max(1, int(math.ceil((maxy - miny) / sea_level_resolution)))
+    dem = gdal.GetDriverByName('GTiff').Create(file, w, h, 1, gdal.GDT_Int16, options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    dem.SetGeoTransform([minx, (maxx - minx) / w, 0, maxy, 0, -(maxy - miny) / h])
+    dem.SetProjection('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],'
+                      'UNIT["degree",0.0174532925199433],AUTHORITY["EPSG","4326"]]')
+    dem.GetRasterBand(1).SetNoDataValue(dem_no_data)
+    dem.GetRasterBand(1).Fill(0)
+    dem = None
+    return file
+
+# DEM and GlobCover clipped to AOI footprint (WKT) plus margin, from the per-AOI clips if they exist
+# returns {'dem': file, 'landcover': file}; AOIs entirely over sea get a sea-level DEM, so Terrain-Correction
+# never falls back to SNAP's online SRTM download
+def aoi_auxdata(footprint, aux_dir, offline=False):
+    minx, maxx, miny, maxy = ogr.CreateGeometryFromWkt(footprint).GetEnvelope()
+    bounds = (minx - aux_margin, miny - aux_margin, maxx + aux_margin, maxy + aux_margin)
+    # rounded, so AOIs which differ only by digitising noise share a clip
+    aoi_path = os.path.join(aux_dir, 'aoi', cache_key('aux', [round(value, 3) for value in bounds], aux_sources))
+    files = {'dem': os.path.join(aoi_path, 'dem.tif'), 'landcover': os.path.join(aoi_path, 'GlobCover.tif')}
+    if os.path.isfile(files['landcover']):
+        if not os.path.isfile(files['dem']):
+            # clips of earlier versions have no DEM over sea
+            gdal.UseExceptions()
+            os.replace(sea_level_dem('%s.%d.tmp' % (files['dem'], os.getpid()), bounds), files['dem'])
+        return files
+
+    gdal.UseExceptions()
+    os.makedirs(aoi_path, exist_ok=True)
+    # parallel jobs with the same AOI each write their own temporary files
+    temporary = '%%s.%d.tmp' % os.getpid()
+    tiles = get_dem_tiles(bounds, aux_dir, offline)
+    if tiles:
+        vrt = gdal.BuildVRT('', tiles, srcNodata=dem_no_data, VRTNodata=dem_no_data)
+        gdal.Warp(temporary % files['dem'], vrt, format='GTiff', outputBounds=bounds, dstNodata=dem_no_data,
+                  creationOptions=['TILED=YES', 'COMPRESS=DEFLATE'])
+        vrt = None
+    else:
+        print('No SRTM tiles cover the AOI, using a sea-level DEM.', flush=True)
+        sea_level_dem(temporary % files['dem'], bounds)
+    os.replace(temporary % files['dem'], files['dem'])
+    # written last, its presence marks a complete clip
+    gdal.Warp(temporary % files['landcover'], get_landcover(aux_dir, offline), format='GTiff', outputBounds=bounds,
+              creationOptions=['TILED=YES', 'COMPRESS=DEFLATE'])
+    os.replace(temporary % files['landcover'], files['landcover'])
+    return files
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the local store of DEM and land cover data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    prewarm_parser = subparsers.add_parser('prewarm', help='fetch DEM tiles and GlobCover for a region')
+    region = prewarm_parser.add_mutually_exclusive_group(required=True)
+    region.add_argument('--aoi', help='vector file (GeoJSON, SHP, KML) of the region')
+    region.add_argument('--bounds', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'), help='region in degrees')
+    prewarm_parser.add_argument('--aux-dir', default=os.path.join(os.getcwd(), 'auxdata'), help='folder of the aux-data store')
+    args = parser.parse_args(argv)
+
+    bounds = args.bounds if args.bounds else vector_bounds(args.aoi)
+    prewarm(bounds, args.aux_dir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import os                                     # data access
+import sys
+import glob                                   # data access
+import json                                   # JSON encoder and decoder
+import time                                   # time assessment
+import shutil                                 # file operations
+import argparse                               # command line interface
+import multiprocessing                        # process pool start method
+from concurrent.futures import ProcessPoolExecutor, as_completed  # one JVM per job process
+
+# Batch runner for many AOIs: every job runs mapflood in its own working directory and process.
+# Downloaded products are shared between jobs through the product cache (see procinfo['cache_dir']).
+#
+# Manifest (JSON):
+# {
+#     "defaults": {"polarisations": "VH", "username": "...", "password": "...", "period_start": [2022, 1, 15], "period_stop": [2022, 1, 25]},
+#     "jobs": [{"name": "district_a", "aoi": "aois/district_a.geojson"},
+#              {"name": "district_b", "aoi": "aois/district_b.shp", "period_start": [2022, 1, 18], "period_stop": [2022, 1, 28]}]
+# }
+# Usage: python batch.py manifest.json --workers 4 --batch-dir batch
+
+# settings which belong to dlinfo, all other job settings go to procinfo
+dlinfo_keys = ['period_start', 'period_stop', 'username', 'password', 'connections', 'catalog', 'offline', 'multi_scene']
+
+# create working directory of job with AOI subfolder holding a copy of the AOI file(s)
+def prepare_workdir(job, batch_path, manifest_path):
+    workdir = os.path.join(batch_path, job['name'])
+    aoi_path = os.path.join(workdir, 'AOI')
+    if os.path.isdir(aoi_path):
+        shutil.rmtree(aoi_path)
+    os.makedirs(aoi_path)
+    aoi = os.path.join(manifest_path, job['aoi'])
+    if os.path.isdir(aoi):
+        files = glob.glob(os.path.join(aoi, '*'))
+    else:
+        # shapefiles come with sidecar files of the same name
+        files = glob.glob('%s.*' % os.path.splitext(aoi)[0]) if aoi.endswith('.shp') else [aoi]
+    for file in files:
+        shutil.copy2(file, aoi_path)
+    return workdir
+
+# worker: run mapflood for one job and return status and timing
+def run_job(job, workdir, dlinfo, procinfo):
+    from main import mapflood
+    from tiling import skipped_tiles
+    start_time = time.time()
+    result = {'name': job['name'], 'workdir': workdir, 'status': 'done', 'error': None}
+    try:
+        mapflood(job.get('polarisations', 'VH'), dlinfo, False, procinfo, directory=workdir)
+        # tiles of large AOIs which failed are gaps in the flood mask
+        result['skipped_tiles'] = skipped_tiles(workdir)
+    except SystemExit as e:
+        # mapflood exits with a message e.g. if no image is available
+        result.update(status='failed', error=str(e).strip())
+    except Exception as e:
+        result.update(status='failed', error='%s: %s' % (type(e).__name__, e))
+    result['wall_s'] = time.time() - start_time
+    return result
+
+def run_batch(manifest_file, batch_path, max_workers=2):
+    from main import dlinfo as default_dlinfo, procinfo as default_procinfo
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    manifest_path = os.path.dirname(os.path.abspath(manifest_file))
+    os.makedirs(batch_path, exist_ok=True)
+    # JAI threads are shared between job processes
+    parallelism = max(1, os.cpu_count() // max_workers)
+
+    submitted = {}
+    results = []
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for job in manifest['jobs']:
+            settings = dict(manifest.get('defaults', {}), **job)
+            dlinfo = dict(default_dlinfo, **{key: value for key, value in settings.items() if key in dlinfo_keys})
+            procinfo = dict(default_procinfo, parallelism=parallelism)
+            procinfo.update({key: value for key, value in settings.items() if key in default_procinfo})
+            workdir = prepare_workdir(settings, batch_path, manifest_path)
+            submitted[pool.submit(run_job, settings, workdir, dlinfo, procinfo)] = job['name']
+        for future in as_completed(submitted):
+            result = future.result()
+            results.append(result)
+            print('Job %-30s %-7s --- %.2f seconds ---%s' % (result['name'], result['status'], result['wall_s'],
+                  '' if result['error'] is None else '  (%s)' % result['error']), flush=True)
+
+    report = {'manifest': os.path.abspath(manifest_file),
+              'wall_s': time.time() - start_time,
+              'jobs': sorted(results, key=lambda result: result['name'])}
+    with open(os.path.join(batch_path, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print('\n%d of %d jobs done in %.2f seconds, report stored in %s.' % (
+        sum(result['status'] == 'done' for result in results), len(results), report['wall_s'],
+        os.path.join(batch_path, 'report.json')), flush=True)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Map floods for many areas of interest in parallel.')
+    parser.add_argument('manifest', help='JSON manifest with jobs (AOI and sensing period)')
+    parser.add_argument('--batch-dir', default=os.path.join(os.getcwd(), 'batch'), help='folder for job working directories')
+    parser.add_argument('--workers', type=int, default=2, help='number of jobs processed at the same time')
+    args = parser.parse_args(argv)
+    report = run_batch(args.manifest, args.batch_dir, args.workers)
+    return 0 if all(result['status'] == 'done' for result in report['jobs']) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
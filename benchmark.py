@@ -0,0 +1,215 @@
+import os                                     # data access
+import sys
+import json                                   # JSON encoder and decoder
+import time                                   # time assessment
+import argparse                               # command line interface
+import tracemalloc                            # peak memory of Python/NumPy allocations
+import numpy as np                            # scientific comupting
+from osgeo import gdal, osr                   # data conversion
+
+# Synthetic-scene benchmark for thresholding, mask filtering, export and flood map loading.
+# Usage: python benchmark.py --sizes 1000 5000 [--update-baseline] [--tolerance 0.15]
+
+default_sizes = [1000, 5000, 10000, 20000]
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# Sentinel-1-like backscatter (linear sigma0) and number of looks for speckle
+land_sigma0 = 0.08                            # about -11 dB
+water_sigma0 = 0.004                          # about -24 dB
+looks = 4.4                                   # equivalent number of looks of GRD products
+
+# random water bodies as discs covering roughly 'water_fraction' of the scene
+def make_water_bodies(size, water_fraction, radius_range, rng):
+    mean_area = np.pi * np.mean(np.square(radius_range))
+    number = max(1, int(water_fraction * size * size / mean_area))
+    centers = rng.uniform(0, size, (number, 2))
+    radii = rng.uniform(radius_range[0], radius_range[1], number)
+    return centers, radii
+
+def water_mask_block(size, y0, rows, centers, radii):
+    mask = np.zeros((rows, size), bool)
+    for (cy, cx), r in zip(centers, radii):
+        top, bottom = max(int(cy - r), y0), min(int(cy + r) + 1, y0 + rows)
+        if top >= bottom:
+            continue
+        left, right = max(int(cx - r), 0), min(int(cx + r) + 1, size)
+        yy, xx = np.ogrid[top:bottom, left:right]
+        mask[top - y0:bottom - y0, left:right] |= (yy - cy)**2 + (xx - cx)**2 <= r**2
+    return mask
+
+# write synthetic dB scene with gamma distributed speckle as GeoTIFF, generated in row blocks
+def make_scene(file, size, water_fraction=0.2, radius_range=(20, 400), seed=0, block_rows=1024):
+    rng = np.random.default_rng(seed)
+    centers, radii = make_water_bodies(size, water_fraction, radius_range, rng)
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(file, size, size, 1, gdal.GDT_Float32, ['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    # about 10 m pixels in geographic coordinates
+    dataset.SetGeoTransform([5.0, 0.0001, 0, 52.0, 0, -0.0001])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetDescription('Sigma0_VH_db')
+    for y0 in range(0, size, block_rows):
+        rows = min(block_rows, size - y0)
+        sigma0 = np.where(water_mask_block(size, y0, rows, centers, radii), water_sigma0, land_sigma0)
+        speckle = rng.gamma(looks, 1.0 / looks, (rows, size))
+        band.WriteArray((10 * np.log10(sigma0 * speckle)).astype(np.float32), 0, y0)
+    dataset.FlushCache()
+    dataset = None
+    return file
+
+# 'Band'-like adapter on a GDAL band so getThreshold can run without SNAP products
+class GdalBand:
+    def __init__(self, band):
+        self.band = band
+
+    def getRasterWidth(self):
+        return self.band.XSize
+
+    def getRasterHeight(self):
+        return self.band.YSize
+
+    def getName(self):
+        return self.band.GetDescription()
+
+    def readPixels(self, x, y, w, h, array):
+        array[:w * h] = self.band.ReadAsArray(x, y, w, h).ravel()
+        return array
+
+# run function and return result, wall time and peak memory
+# peak_rss_mb is the RSS high-water mark of the run and includes the JVM, tracemalloc only sees Python allocations
+def measure(function, *args):
+    from profiling import reset_peak_rss, read_peak_rss_mb
+    reset = reset_peak_rss()
+    tracemalloc.start()
+    start_time = time.time()
+    result = function(*args)
+    wall = time.time() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, wall, {'python_peak_mb': peak / 1024**2,
+                          'peak_rss_mb': read_peak_rss_mb() if reset else None}
+
+def bench_threshold(scene):
+    from processing import getThreshold
+    dataset = gdal.Open(scene)
+    return getThreshold(GdalBand(dataset.GetRasterBand(1)))
+
+def bench_mask_filtering(mask_product):
+    from maskfilter import filter_flood_mask
+    return filter_flood_mask(mask_product)
+
+# compare 5x5 majority with the median of every full 5x5 window of the whole mask (image border excluded)
+# in row blocks, each read with the 2 rows above and below its windows need
+def matches_median(mask_product, mask_image, block_rows=256):
+    from writeoutput import mask_dataset
+    from numpy.lib.stride_tricks import sliding_window_view
+    mask_band = mask_dataset(mask_product).GetRasterBand(1)
+    filtered_band = mask_image.GetRasterBand(1)
+    w, h = mask_band.XSize, mask_band.YSize
+    for y in range(2, h - 2, block_rows):
+        rows = min(block_rows, h - 2 - y)
+        mask = mask_band.ReadAsArray(0, y - 2, w, rows + 4)
+        median = np.median(sliding_window_view(mask, (5, 5)), axis=(-2, -1)).astype(np.uint8)
+        if not np.array_equal(median, filtered_band.ReadAsArray(0, y, w, rows)[:, 2:-2]):
+            return False
+    return True
+
+def bench_writingoutput(mask_product, workdir, name):
+    from writeoutput import writingoutput
+    writingoutput(mask_product, workdir, name, 'processed_VH', 'VH')
+
+def bench_plotfloodmap_loading(workdir, name):
+    from showmaps import load_floodmap_data
+    load_floodmap_data(name, 'VH', workdir, 'processed_VH')
+
+def run_size(size, workdir, results):
+    import snappy                             # SNAP Python interface
+    from processing import binarize
+    scene = os.path.join(workdir, 'synthetic_%d.tif' % size)
+    name = 'synthetic_%d.zip' % size
+    if not os.path.isfile(scene):
+        print('Generating %d x %d scene...' % (size, size), flush=True)
+        make_scene(scene, size)
+    mpix = size * size / 1e6
+
+    threshold, wall, memory = measure(bench_threshold, scene)
+    results['getThreshold_%d' % size] = dict(memory, wall_s=wall, mpix_per_s=mpix / wall)
+
+    S1_product = snappy.ProductIO.readProduct(scene)
+    band_name = S1_product.getBandNames()[0]
+    mask_product = binarize(S1_product, ['if (%s < %s) then 1 else NaN' % (band_name, threshold)])
+    mask_image, wall, memory = measure(bench_mask_filtering, mask_product)
+    results['mask_filtering_%d' % size] = dict(memory, wall_s=wall, mpix_per_s=mpix / wall,
+                                               matches_median=matches_median(mask_product, mask_image))
+    if not results['mask_filtering_%d' % size]['matches_median']:
+        print('Mask filter differs from 5x5 median.', flush=True)
+
+    _, wall, memory = measure(bench_writingoutput, mask_product, workdir, name)
+    results['writingoutput_%d' % size] = dict(memory, wall_s=wall, mpix_per_s=mpix / wall)
+
+    _, wall, memory = measure(bench_plotfloodmap_loading, workdir, name)
+    results['plotfloodmap_loading_%d' % size] = dict(memory, wall_s=wall, mpix_per_s=mpix / wall)
+
+# compare throughput and memory with stored baseline, return list of regressions
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        if result['mpix_per_s'] < baseline[key]['mpix_per_s'] * (1 - tolerance):
+            regressions.append('%s: throughput %.2f Mpix/s vs baseline %.2f Mpix/s'
+                               % (key, result['mpix_per_s'], baseline[key]['mpix_per_s']))
+        if result['python_peak_mb'] > baseline[key]['python_peak_mb'] * (1 + tolerance):
+            regressions.append('%s: peak memory %.1f MB vs baseline %.1f MB'
+                               % (key, result['python_peak_mb'], baseline[key]['python_peak_mb']))
+        # RSS covers SNAP's JVM and GDAL as well, only comparable if both runs could measure it
+        if result.get('peak_rss_mb') and baseline[key].get('peak_rss_mb') and \
+                result['peak_rss_mb'] > baseline[key]['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('%s: peak RSS %.1f MB vs baseline %.1f MB'
+                               % (key, result['peak_rss_mb'], baseline[key]['peak_rss_mb']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark flood mapping on synthetic Sentinel-1 scenes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='scene edge lengths in pixels')
+    parser.add_argument('--workdir', default=os.path.join(os.getcwd(), 'benchmark'), help='folder for scenes and outputs')
+    parser.add_argument('--baseline', default=baseline_file, help='JSON file with stored baseline results')
+    parser.add_argument('--update-baseline', action='store_true', help='store results as new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative slowdown or memory increase')
+    args = parser.parse_args(argv)
+
+    gdal.UseExceptions()
+    os.makedirs(args.workdir, exist_ok=True)
+    results = {}
+    for size in args.sizes:
+        run_size(size, args.workdir, results)
+
+    print('\n%-32s %10s %12s %14s %14s' % ('Benchmark', 'Mpix/s', 'Wall [s]', 'Peak [MB]', 'Peak RSS [MB]'))
+    for key, result in results.items():
+        print('%-32s %10.2f %12.2f %14.1f %14s' % (key, result['mpix_per_s'], result['wall_s'], result['python_peak_mb'],
+                                                  '%.1f' % result['peak_rss_mb'] if result['peak_rss_mb'] else '-'))
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print('\nBaseline stored in %s.' % args.baseline)
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print('\nNo baseline found. Run with --update-baseline to store one.')
+        return 0
+    with open(args.baseline, 'r') as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
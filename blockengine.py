@@ -0,0 +1,148 @@
+import os                                     # data access
+import time                                   # time assessment
+import multiprocessing                        # process pool start method
+from collections import deque                 # blocks in flight
+from concurrent.futures import ProcessPoolExecutor  # one GDAL handle per worker process
+import numpy as np                            # scientific comupting
+from osgeo import gdal                        # windowed reading and streamed writing
+from maskfilter import mask_filter_defaults, window_steps, remove_small_areas
+from aoi import aoi_layer
+
+# Block engine for the stages after terrain correction: threshold application, GlobCover exclusion
+# (land_cover_GlobCover != 210), mask filtering and AOI clipping run as NumPy kernels on row blocks of the terrain
+# corrected bands, read through GDAL in a pool of worker processes. Every block is read with a halo of rows for
+# the window operations of the mask filter, so the result equals processing the whole raster at once.
+# Finished blocks stream in order into a tiled GeoTIFF, at most two blocks per worker are held in memory.
+# Only the minimum mapping unit (mask_filter 'min_area') needs the whole mask and runs after streaming.
+# The engine does not use SNAP, so worker processes start without a JVM.
+
+# settings of the engine, procinfo['block_engine'] overrides them
+block_engine_defaults = {
+    'block_rows'        : 1024,                   # rows per block, memory per block is about 6 bytes per pixel and band
+    'workers'           : None                    # worker processes, None uses all cores (main.py passes procinfo['parallelism'],
+                                                  # the share of the cores of one job in batch and service runs)
+}
+
+# plan of the worker process, its open GDAL datasets and the AOI layer in the raster projection
+worker_plan = {}
+worker_datasets = {}
+worker_aoi = {}
+
+def init_worker(plan):
+    worker_plan.update(plan)
+    gdal.UseExceptions()
+    # the AOI is transformed into the raster projection once per worker, not per block
+    if plan['clip']:
+        worker_aoi['vector'], worker_aoi['layer'] = aoi_layer(plan['clip'], plan['projection'])
+
+def read_rows(file, top, bottom):
+    if file not in worker_datasets:
+        worker_datasets[file] = gdal.Open(file)
+    band = worker_datasets[file].GetRasterBand(1)
+    return band.ReadAsArray(0, top, band.XSize, bottom - top)
+
+# 1 for pixels of rows [y0, y1) inside of the AOI layer of the worker, only the block window is rasterized
+def aoi_rows(plan, y0, y1):
+    x0, dx, rx, top, ry, dy = plan['geotransform']
+    inside_image = gdal.GetDriverByName('MEM').Create('', plan['width'], y1 - y0, 1, gdal.GDT_Byte)
+    inside_image.SetGeoTransform([x0 + y0 * rx, dx, rx, top + y0 * dy, ry, dy])
+    inside_image.SetProjection(plan['projection'])
+    gdal.RasterizeLayer(inside_image, [1], worker_aoi['layer'], burn_values=[1])
+    return inside_image.GetRasterBand(1).ReadAsArray()
+
+# flood mask (bands x rows) of rows [y0, y1): 1 where band < threshold outside of permanent water,
+# filtered on the block plus halo rows and clipped to the AOI
+def flood_block(y0, y1):
+    plan = worker_plan
+    top = max(0, y0 - plan['halo'])
+    bottom = min(plan['height'], y1 + plan['halo'])
+    land_cover = read_rows(plan['land_cover'], top, bottom) if plan['land_cover'] else None
+    inside = aoi_rows(plan, y0, y1) if plan['clip'] else None
+    masks = []
+    for file, threshold in zip(plan['bands'], plan['thresholds']):
+        # comparisons are false for NaN, the no-data value 0 dB lies above any threshold
+        flooded = read_rows(file, top, bottom) < threshold
+        if land_cover is not None:
+            flooded &= land_cover != 210
+        mask = flooded.astype(np.uint8)
+        for function, size in plan['steps']:
+            mask = function(mask, size)
+        mask = mask[y0 - top:y0 - top + y1 - y0]
+        if inside is not None:
+            mask *= inside
+        masks.append(mask)
+    return y0, masks
+
+# stream the flood mask of terrain corrected band files into output_file (tiled GeoTIFF, or COG if cog is set)
+# band_files: GDAL-readable single-band rasters of one grid, e.g. rasterstore.StoredProduct.band_file
+# land_cover_file: GlobCover band on the same grid, None skips the permanent water exclusion
+# mask_filter: dict overriding maskfilter.mask_filter_defaults, clip: exact AOI (WKT) or None
+# returns output_file (1 = flooded, 0 = no-data)
+def stream_flood_mask(band_files, band_names, land_cover_file, thresholds, geotransform, projection, output_file,
+                      mask_filter=None, clip=None, cog=None, settings=None):
+    from writeoutput import cog_options
+    print('6. Binarization (blocks):     ', end='', flush=True)
+    start_time = time.time()
+    gdal.UseExceptions()
+    settings = dict(block_engine_defaults, **(settings or {}))
+    mask_filter = dict(mask_filter_defaults, **(mask_filter or {}))
+    steps, halo = window_steps(mask_filter['majority'], mask_filter['opening'], mask_filter['closing'])
+    source = gdal.Open(band_files[0])
+    w, h = source.RasterXSize, source.RasterYSize
+    source = None
+    plan = {'bands'        : list(band_files),
+            'land_cover'   : land_cover_file,
+            'thresholds'   : [float(t) for t in thresholds],
+            'steps'        : steps,
+            'halo'         : halo,
+            'width'        : w,
+            'height'       : h,
+            'geotransform' : list(geotransform),
+            'projection'   : projection,
+            'clip'         : clip}
+
+    # written to a temporary file first, so readers never see a partial mask
+    temporary = '%s.%d.tmp.tif' % (os.path.splitext(output_file)[0], os.getpid())
+    block_rows = settings['block_rows']
+    mask_image = gdal.GetDriverByName('GTiff').Create(temporary, w, h, len(band_files), gdal.GDT_Byte,
+                                                      options=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+                                                               'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    mask_image.SetGeoTransform(geotransform)
+    mask_image.SetProjection(projection)
+    for i, name in enumerate(band_names):
+        mask_band = mask_image.GetRasterBand(i + 1)
+        mask_band.SetNoDataValue(0)
+        mask_band.SetDescription(name)
+
+    def write_block(future):
+        y0, masks = future.result()
+        for i, mask in enumerate(masks):
+            mask_image.GetRasterBand(i + 1).WriteArray(mask, 0, y0)
+
+    workers = settings['workers'] or os.cpu_count()
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(plan,)) as pool:
+        pending = deque()
+        for y0 in range(0, h, block_rows):
+            pending.append(pool.submit(flood_block, y0, min(y0 + block_rows, h)))
+            # bounded memory: wait for the oldest block before submitting more
+            if len(pending) >= 2 * workers:
+                write_block(pending.popleft())
+        while pending:
+            write_block(pending.popleft())
+
+    # connected areas can span any number of blocks, so the minimum mapping unit runs on the whole mask
+    if mask_filter['min_area'] > 1:
+        for i in range(len(band_files)):
+            mask_band = mask_image.GetRasterBand(i + 1)
+            mask_band.WriteArray(remove_small_areas(mask_band.ReadAsArray(), mask_filter['min_area']))
+    if cog is not None:
+        mask_image = None
+        gdal.Translate(temporary + '.cog', temporary, format='COG', creationOptions=cog_options(**cog))
+        os.replace(temporary + '.cog', temporary)
+    else:
+        mask_image.FlushCache()
+        mask_image = None
+    os.replace(temporary, output_file)
+    print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
+    return output_file
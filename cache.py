@@ -0,0 +1,155 @@
+import os                                     # data access
+import json                                   # JSON encoder and decoder
+import time                                   # time assessment
+import shutil                                 # file operations
+import hashlib                                # content hashes
+import fcntl                                  # inter-process locks
+from contextlib import contextmanager
+
+# content hash of any JSON-serialisable parts, e.g. product UUID, AOI footprint and stage parameters
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def file_checksum(file, chunk_size=8 * 1024 * 1024):
+    checksum = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+# relative path -> (size, sha256, mtime) for all files below path
+def list_files(path):
+    files = {}
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            file = os.path.join(root, name)
+            if name == 'manifest.json' and root == path:
+                continue
+            files[os.path.relpath(file, path)] = (os.path.getsize(file), file_checksum(file), os.path.getmtime(file))
+    return files
+
+# hard link if possible (same file system), copy otherwise
+# only for files which are read, never rewritten in place, e.g. restoring a cached product zip
+def link_or_copy(source, target):
+    if os.path.isdir(source):
+        shutil.copytree(source, target, copy_function=link_or_copy)
+        return target
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+    return target
+
+# local cache of downloaded products and intermediate rasters with size-bounded LRU eviction
+# every entry is a folder <root>/<key> with the cached files and a manifest of their sizes, checksums and mtimes
+class Cache:
+    def __init__(self, root, max_gb=50):
+        self.root = root
+        self.max_bytes = max_gb * 1024**3
+        os.makedirs(root, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def read_manifest(self, key):
+        try:
+            with open(os.path.join(self.entry_path(key), 'manifest.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, key, manifest):
+        file = os.path.join(self.entry_path(key), 'manifest.json')
+        with open(file + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(file + '.tmp', file)
+
+    # True if all files of entry exist with the size and mtime (checksum if full) of the manifest
+    def check(self, key, manifest, full=False):
+        path = self.entry_path(key)
+        for name, (size, checksum, *mtime) in manifest['files'].items():
+            file = os.path.join(path, name)
+            if not os.path.isfile(file) or os.path.getsize(file) != size:
+                return False
+            # entries of older manifests have no mtime and are hashed
+            if (full or not mtime) and file_checksum(file) != checksum:
+                return False
+            if not full and mtime and os.path.getmtime(file) != mtime[0]:
+                return False
+        return True
+
+    # return folder of valid entry and mark it as recently used, None if missing or changed
+    # size and mtime are checked on every hit, checksums only by verify (e.g. when a product is restored)
+    def get(self, key):
+        manifest = self.read_manifest(key)
+        if manifest is None:
+            return None
+        if not self.check(key, manifest):
+            print('Cache entry %s is corrupt and will be removed.' % key, flush=True)
+            self.remove(key)
+            return None
+        path = self.entry_path(key)
+        manifest['last_access'] = time.time()
+        self.write_manifest(key, manifest)
+        return path
+
+    # full checksum pass over entry, removes it if any file has changed
+    def verify(self, key):
+        manifest = self.read_manifest(key)
+        if manifest is None or not self.check(key, manifest, full=True):
+            print('Cache entry %s is corrupt and will be removed.' % key, flush=True)
+            self.remove(key)
+            return False
+        return True
+
+    # move files or folders into entry under key and return entry folder
+    # sources are moved, not linked, so later runs writing to the same paths cannot change the entry
+    def put(self, key, sources, **info):
+        path = self.entry_path(key)
+        if os.path.isdir(path):
+            self.remove(key)
+        staging = path + '.tmp'
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        for source in sources:
+            shutil.move(source, os.path.join(staging, os.path.basename(source)))
+        os.replace(staging, path)
+        files = list_files(path)
+        self.write_manifest(key, {'files'       : files,
+                                  'size'        : sum(size for size, checksum, mtime in files.values()),
+                                  'created'     : time.time(),
+                                  'last_access' : time.time(),
+                                  'info'        : info})
+        self.evict(keep=key)
+        return path
+
+    # exclusive lock on key across processes, e.g. so parallel jobs download a product only once
+    @contextmanager
+    def lock(self, key):
+        with open(os.path.join(self.root, '%s.lock' % key), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    # remove least recently used entries until cache fits into max_bytes
+    def evict(self, keep=None):
+        entries = []
+        for key in os.listdir(self.root):
+            manifest = self.read_manifest(key)
+            if manifest is not None:
+                entries.append((manifest['last_access'], manifest['size'], key))
+        total = sum(size for last_access, size, key in entries)
+        for last_access, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            print('Cache full, removing %s.' % key, flush=True)
+            self.remove(key)
+            total -= size
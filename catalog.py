@@ -0,0 +1,134 @@
+import os                                     # data access
+import json                                   # JSON encoder and decoder
+import sqlite3                                # local product database
+from collections import OrderedDict
+from datetime import datetime, time           # dates, times and intervalls
+from osgeo import ogr                         # footprint geometries
+
+# product properties contain datetimes, which are stored as tagged ISO strings
+def encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    return str(value)
+
+def decode(value):
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+def as_datetime(value):
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    return datetime.combine(value, time())
+
+# merge (start, end) intervals and return parts of [start, end) they do not cover
+def missing_intervals(covered, start, end):
+    missing = []
+    current = start
+    for covered_start, covered_end in sorted(covered):
+        if covered_end <= current:
+            continue
+        if covered_start > current:
+            missing.append((current, min(covered_start, end)))
+        current = max(current, covered_end)
+        if current >= end:
+            break
+    if current < end:
+        missing.append((current, end))
+    return [(s, e) for s, e in missing if s < e]
+
+# persistent catalog of hub query results with an R-tree on product footprints
+# coverage records which area, sensing period and filters have already been queried,
+# so only new time ranges go to the hub and repeated searches are answered locally
+class Catalog:
+    def __init__(self, file):
+        if os.path.dirname(file):
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+        # catalog can be shared by parallel jobs, wait for their writes
+        self.connection = sqlite3.connect(file, timeout=60)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS products (
+                id            INTEGER PRIMARY KEY,
+                uuid          TEXT UNIQUE,
+                filters       TEXT,
+                beginposition TEXT,
+                ingestiondate TEXT,
+                footprint     TEXT,
+                properties    TEXT);
+            CREATE VIRTUAL TABLE IF NOT EXISTS footprints USING rtree(id, minx, maxx, miny, maxy);
+            CREATE TABLE IF NOT EXISTS coverage (
+                filters TEXT,
+                minx REAL, maxx REAL, miny REAL, maxy REAL,
+                start TEXT,
+                end   TEXT);
+            CREATE INDEX IF NOT EXISTS products_begin ON products (filters, beginposition);''')
+
+    def close(self):
+        self.connection.close()
+
+    # store products as returned by SentinelAPI.query
+    def store(self, products, filters):
+        with self.connection:
+            for uuid, properties in products.items():
+                geom = ogr.CreateGeometryFromWkt(properties['footprint'])
+                minx, maxx, miny, maxy = geom.GetEnvelope()
+                cursor = self.connection.execute('SELECT id FROM products WHERE uuid = ?', (uuid,))
+                row = cursor.fetchone()
+                values = (filters, as_datetime(properties['beginposition']).isoformat(),
+                          as_datetime(properties['ingestiondate']).isoformat(), properties['footprint'],
+                          json.dumps(properties, default=encode))
+                if row is None:
+                    cursor = self.connection.execute('INSERT INTO products (uuid, filters, beginposition, ingestiondate, footprint, properties) '
+                                                     'VALUES (?, ?, ?, ?, ?, ?)', (uuid,) + values)
+                    product_id = cursor.lastrowid
+                else:
+                    product_id = row[0]
+                    self.connection.execute('UPDATE products SET filters = ?, beginposition = ?, ingestiondate = ?, footprint = ?, '
+                                            'properties = ? WHERE id = ?', values + (product_id,))
+                self.connection.execute('INSERT OR REPLACE INTO footprints VALUES (?, ?, ?, ?, ?)', (product_id, minx, maxx, miny, maxy))
+
+    def add_coverage(self, envelope, filters, start, end):
+        minx, maxx, miny, maxy = envelope
+        with self.connection:
+            self.connection.execute('INSERT INTO coverage VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (filters, minx, maxx, miny, maxy, start.isoformat(), end.isoformat()))
+
+    # time ranges of [start, end) not yet queried for an area containing envelope
+    def missing_ranges(self, envelope, filters, start, end):
+        minx, maxx, miny, maxy = envelope
+        rows = self.connection.execute('SELECT start, end FROM coverage WHERE filters = ? AND minx <= ? AND maxx >= ? '
+                                       'AND miny <= ? AND maxy >= ?', (filters, minx, maxx, miny, maxy)).fetchall()
+        covered = [(datetime.fromisoformat(s), datetime.fromisoformat(e)) for s, e in rows]
+        return missing_intervals(covered, start, end)
+
+    # products intersecting footprint (WKT) with sensing start in [start, end), sorted by ingestion date
+    def search(self, footprint, start, end, filters):
+        geom = ogr.CreateGeometryFromWkt(footprint)
+        minx, maxx, miny, maxy = geom.GetEnvelope()
+        rows = self.connection.execute('SELECT p.uuid, p.footprint, p.properties FROM products p JOIN footprints f ON p.id = f.id '
+                                       'WHERE f.minx <= ? AND f.maxx >= ? AND f.miny <= ? AND f.maxy >= ? '
+                                       'AND p.filters = ? AND p.beginposition >= ? AND p.beginposition < ? ORDER BY p.ingestiondate',
+                                       (maxx, minx, maxy, miny, filters, start.isoformat(), end.isoformat())).fetchall()
+        products = OrderedDict()
+        for uuid, product_footprint, properties in rows:
+            # R-tree only compares bounding boxes
+            if geom.Intersects(ogr.CreateGeometryFromWkt(product_footprint)):
+                products[uuid] = json.loads(properties, object_hook=decode)
+        return products
+
+    # drop-in for SentinelAPI.query(footprint, date=(start, end), **filters)
+    # only uncovered time ranges are queried from the hub, offline=True answers from the catalog alone
+    def query(self, api, footprint, date, offline=False, **filters):
+        start, end = as_datetime(date[0]), as_datetime(date[1])
+        filters_key = json.dumps(filters, sort_keys=True)
+        envelope = ogr.CreateGeometryFromWkt(footprint).GetEnvelope()
+        if not offline:
+            # the hub is queried with the AOI bounding box, so coverage is exact for any AOI inside it
+            minx, maxx, miny, maxy = envelope
+            bbox = 'POLYGON((%r %r, %r %r, %r %r, %r %r, %r %r))' % (minx, miny, maxx, miny, maxx, maxy, minx, maxy, minx, miny)
+            for missing_start, missing_end in self.missing_ranges(envelope, filters_key, start, end):
+                products = api.query(bbox, date=(missing_start, missing_end), **filters)
+                self.store(products, filters_key)
+                # the hub can still receive products for recent acquisitions, so only the past counts as covered
+                self.add_coverage(envelope, filters_key, missing_start, min(missing_end, datetime.utcnow()))
+        return self.search(footprint, start, end, filters_key)
@@ -1,29 +1,48 @@
 import sys
 import pandas as pd
+import shapely.wkt                            # AOI geometry for coverage scoring
 import os                                     # data access
-import glob                                   # data access
+import json                                   # JSON encoder and decoder
+import hashlib                                # checksum verification
+import threading                              # download progress lock
+from concurrent.futures import ThreadPoolExecutor  # parallel range requests
 from collections import OrderedDict
-from sentinelsat.sentinel import SentinelAPI, read_geojson, geojson_to_wkt  # interface to Open Access Hub
 from datetime import date                     # dates, times and intervalls
-from IPython.display import display
+from cache import cache_key, link_or_copy
 
-def get_first_product_id(api, footprint, downloadinfo):
+# show table in notebooks, print it in headless runs
+def display(table):
+    try:
+        from IPython.display import display as show
+        show(table)
+    except ImportError:
+        print(table.to_string(), flush=True)
+
+# catalog: optional local Catalog answering repeated searches, offline searches the catalog only
+def query_products(api, footprint, downloadinfo, catalog=None, offline=False):
+    from sentinelsat.exceptions import UnauthorizedError
     # search Copernicus Open Access Hub for products with regard to input footprint and sensing period
+    # only a rejected login is reported as such, catalog (SQLite) and connection errors are raised as they are
     try: 
         # !!! SOMEHOW THIS DOESNT WORK INSIDE A FUNCTION because the package datatime is missing... 
-        products = api.query(footprint,
-                             date = (date(downloadinfo['period_start'][0], downloadinfo['period_start'][1], downloadinfo['period_start'][2]),
-                                     date(downloadinfo['period_stop'][0], downloadinfo['period_stop'][1], downloadinfo['period_stop'][2])),
-                             platformname = 'Sentinel-1',
-                             producttype = 'GRD')
+        period = (date(downloadinfo['period_start'][0], downloadinfo['period_start'][1], downloadinfo['period_start'][2]),
+                  date(downloadinfo['period_stop'][0], downloadinfo['period_stop'][1], downloadinfo['period_stop'][2]))
+        if catalog is None:
+            products = api.query(footprint, date = period, platformname = 'Sentinel-1', producttype = 'GRD')
+        else:
+            products = catalog.query(api, footprint, period, offline, platformname = 'Sentinel-1', producttype = 'GRD')
         print('Successfully connected to Copernicus Open Access Hub.\n', flush=True)
-    except:
+    except UnauthorizedError:
         sys.exit('\nLogin data not valid. Please change username and/or password.')
 
     # THIS IS NOT WOKRING raise warning that no image is available in given sensing period
     products_json = api.to_geojson(products)
     if not products_json['features']:
         sys.exit('\nNo Sentinel-1 images available. Please change sensing period in user input section.')
+    return(products)
+
+def get_first_product_id(api, footprint, downloadinfo, catalog=None, offline=False):
+    products = query_products(api, footprint, downloadinfo, catalog, offline)
 
         # convert to dataframe to show product information
     products_df = api.to_dataframe(products).sort_values('ingestiondate', ascending=[True])
@@ -40,23 +59,242 @@ def get_first_product_id(api, footprint, downloadinfo):
     
     return(firstproduct_id, firstproduct_json)
     
-def downloadproduct(api, firstproduct_id, directory):
+# label products (GeoDataFrame) by pass: same relative orbit, acquired without a gap of more than max_gap_s
+# between consecutive slices; a key of orbit and day would split passes crossing midnight UTC
+def pass_names(products_gdf, max_gap_s=60):
+    names = {}
+    previous = None
+    for index, product in products_gdf.sort_values(['relativeorbitnumber', 'beginposition']).iterrows():
+        if (previous is None or product['relativeorbitnumber'] != previous['relativeorbitnumber']
+                or (product['beginposition'] - previous['endposition']).total_seconds() > max_gap_s):
+            name = '%s_%s' % (product['relativeorbitnumber'], product['beginposition'].strftime('%Y%m%dT%H%M%S'))
+        names[index] = name
+        previous = product
+    return pd.Series(names)
+
+# smallest run of consecutive slices of one pass (GeoDataFrame) covering the AOI, or covering most of it
+# SliceAssembly can only join slices which follow each other along the track, so no slice may be left out in between
+def select_covering(group, aoi, min_coverage):
+    index = list(group.sort_values('beginposition').index)
+    best, best_score = [], None
+    for i in range(len(index)):
+        union = None
+        for j in range(i, len(index)):
+            geometry = group.geometry[index[j]]
+            union = geometry if union is None else union.union(geometry)
+            covered = union.intersection(aoi).area / aoi.area
+            # enough coverage first, then fewer slices, then more coverage
+            score = (min(covered, min_coverage), -(j - i + 1), covered)
+            if best_score is None or score > best_score:
+                best, best_score = index[i:j + 1], score
+            if covered >= min_coverage:
+                break
+    return best, (best_score[2] if best_score else 0.0)
+
+# choose smallest set of products of one pass (see pass_names) covering the AOI,
+# products within a pass can be slice-assembled. Passes are scored by covered AOI fraction
+# weighted by closeness of acquisition to period start (score halves after date_scale days)
+def get_covering_product_ids(api, footprint, downloadinfo, catalog=None, offline=False, min_coverage=0.99, date_scale=10):
+    products = query_products(api, footprint, downloadinfo, catalog, offline)
+    aoi = shapely.wkt.loads(footprint)
+    products_gdf = api.to_geodataframe(products)
+    # vectorized overlap of all footprints with AOI
+    products_gdf['coverage'] = products_gdf.geometry.intersection(aoi).area / aoi.area
+    products_gdf = products_gdf[products_gdf['coverage'] > 0]
+    if products_gdf.empty:
+        sys.exit('\nNo Sentinel-1 image overlaps the area of interest.')
+    reference = pd.Timestamp(date(*downloadinfo['period_start']))
+    products_gdf['days'] = (products_gdf['beginposition'].dt.tz_localize(None) - reference).abs().dt.total_seconds() / 86400
+    products_gdf['pass'] = pass_names(products_gdf)
+
+    best = None
+    for name, group in products_gdf.groupby('pass'):
+        selected, covered = select_covering(group, aoi, min_coverage)
+        score = covered / (1 + group['days'].min() / date_scale)
+        # fewer products wins on equal score
+        if best is None or (score, -len(selected)) > (best[0], -len(best[1])):
+            best = (score, selected, covered)
+    score, selected, covered = best
+    # slices are assembled in order of acquisition
+    product_ids = list(products_gdf.loc[selected].sort_values('beginposition')['uuid'])
+    print('Sentinel-1 image(s) to download: %s (%.1f%% of AOI covered)' % (', '.join(product_ids), 100 * covered), flush=True)
+    if covered < min_coverage:
+        print('Warning: no single pass covers the whole area of interest.', flush=True)
+    pd.set_option('display.max_colwidth', None)
+    display(products_gdf.loc[selected, ['filename', 'size', 'beginposition', 'coverage', 'days']])
+
+    selected_products = OrderedDict((product_id, products[product_id]) for product_id in product_ids)
+    return(product_ids, api.to_geojson(selected_products))
+
+# split byte range of file of 'size' bytes into about equal parts, one per connection
+def split_ranges(size, connections, min_part_size=16 * 1024**2):
+    number = max(1, min(connections, size // min_part_size))
+    bounds = [size * i // number for i in range(number + 1)]
+    return [{'start': bounds[i], 'end': bounds[i + 1] - 1, 'done': 0} for i in range(number)]
+
+def write_progress(state_file, state):
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(state_file + '.tmp', state_file)
+
+def file_md5(file, chunk_size=8 * 1024**2):
+    checksum = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+# size of remote file and whether the server accepts range requests
+def probe(session, url):
+    response = session.head(url, allow_redirects=True, timeout=60)
+    response.raise_for_status()
+    size = response.headers.get('Content-Length')
+    return (int(size) if size else None), response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+# count bytes written to file f as done only once they are on disk, then record progress of all parts
+def commit_progress(f, part, written, state, state_file, lock):
+    f.flush()
+    os.fsync(f.fileno())
+    with lock:
+        part['done'] += written
+        write_progress(state_file, state)
+
+# download one part of the file with a range request, progress is recorded in state
+# 'done' only counts flushed bytes, so a resume after a crash never skips bytes which did not reach the file
+def download_range(session, url, partial, part, state, state_file, lock, chunk_size=1024**2, sync_chunks=64):
+    offset = part['start'] + part['done']
+    if offset > part['end']:
+        return
+    headers = {'Range': 'bytes=%d-%d' % (offset, part['end'])}
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError('Server ignored range request for %s' % url)
+        with open(partial, 'r+b') as f:
+            f.seek(offset)
+            written = 0
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    written += len(chunk)
+                    # store progress about every 64 MB of this part to allow resuming
+                    if written >= sync_chunks * chunk_size:
+                        commit_progress(f, part, written, state, state_file, lock)
+                        written = 0
+            finally:
+                # bytes received before an interruption are kept as well
+                commit_progress(f, part, written, state, state_file, lock)
+
+# resumable download of url to file with several range connections and MD5 check
+# a partial download is kept as <file>.incomplete with progress in <file>.progress.json
+def download_file(session, url, file, size=None, md5=None, connections=4, retries=3):
+    partial = file + '.incomplete'
+    state_file = file + '.progress.json'
+    if os.path.isfile(file) and (md5 is None or file_md5(file).lower() == md5.lower()):
+        return file
+    remote_size, ranges = probe(session, url)
+    size = size or remote_size
+
+    if not ranges or not size:
+        # no range support: plain streaming download without resume
+        with session.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(partial, 'wb') as f:
+                for chunk in response.iter_content(1024**2):
+                    f.write(chunk)
+    else:
+        state = None
+        if os.path.isfile(partial) and os.path.isfile(state_file):
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+            if state.get('size') != size or state.get('url') != url:
+                state = None
+            else:
+                print('Resuming download at %.0f%%.' % (100 * sum(p['done'] for p in state['parts']) / size), flush=True)
+        if state is None:
+            state = {'url': url, 'size': size, 'parts': split_ranges(size, connections)}
+            with open(partial, 'wb') as f:
+                f.truncate(size)
+            write_progress(state_file, state)
+        lock = threading.Lock()
+        for attempt in range(retries):
+            pending = [part for part in state['parts'] if part['start'] + part['done'] <= part['end']]
+            if not pending:
+                break
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                futures = [executor.submit(download_range, session, url, partial, part, state, state_file, lock) for part in pending]
+                errors = [future.exception() for future in futures if future.exception() is not None]
+            for error in errors:
+                print('Download interrupted (%s), retrying.' % error, flush=True)
+        if any(part['start'] + part['done'] <= part['end'] for part in state['parts']):
+            raise IOError('Download of %s incomplete after %d attempts, run again to resume.' % (url, retries))
+
+    if md5 and file_md5(partial).lower() != md5.lower():
+        os.remove(partial)
+        if os.path.isfile(state_file):
+            os.remove(state_file)
+        raise IOError('MD5 checksum of %s does not match, partial download removed.' % file)
+    os.replace(partial, file)
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+    return file
+
+def downloadproduct(api, firstproduct_id, directory, connections=4):
     product_info = api.get_product_odata(firstproduct_id)
     # check whether product is available
     if product_info['Online']:
         # check if input folder exists, if not create input folder
         input_path = os.path.join(directory, 'input')
         if not os.path.isdir(input_path):
-            os.mkdir(input_path)
-        # change into 'input' subfolder for storing product
-        os.chdir(input_path)
+            os.makedirs(input_path, exist_ok=True)
         # status update
         print('\nProduct %s is online. Starting download.' % firstproduct_id, flush=True)
-        # download product
-        api.download(firstproduct_id)
-        # change back to previous working directory
-        os.chdir(directory)
+        # download product into 'input' subfolder, resuming partial downloads and verifying MD5
+        input_name = '%s.zip' % product_info['title']
+        download_file(api.session, product_info['url'], os.path.join(input_path, input_name),
+                      product_info['size'], product_info['md5'], connections)
         print('Downloading done.')
+        return(input_name)
     else:
         print('\nProduct %s is not online. Must be requested manually.\n' % firstproduct_id, flush=True)
+
+# restore product from cache or download it and add it to cache, returns file name in 'input' subfolder
+def get_product(api, product_id, directory, cache=None, connections=4):
+    if cache is None:
+        return(fetch_product(api, product_id, directory, None, connections))
+    # jobs running in parallel wait for each other instead of downloading the same product twice
+    with cache.lock(cache_key('product', product_id)):
+        return(fetch_product(api, product_id, directory, cache, connections))
+
+# get several products concurrently (see get_product), e.g. the slices of one pass
+# returns file names in 'input' subfolder in the order of product_ids
+def prefetch_products(api, product_ids, directory, cache=None, connections=4, max_workers=2):
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(product_ids)))) as executor:
+        return(list(executor.map(lambda product_id: get_product(api, product_id, directory, cache, connections), product_ids)))
+
+def fetch_product(api, product_id, directory, cache=None, connections=4):
+    input_path = os.path.join(directory, 'input')
+    key = cache_key('product', product_id)
+    entry = cache.get(key) if cache else None
+    # hits are only checked by size and mtime, a restored product zip is also checked against its checksum
+    if entry and not cache.verify(key):
+        entry = None
+    if entry:
+        input_name = [name for name in os.listdir(entry) if name.endswith('.zip')][0]
+        if not os.path.isdir(input_path):
+            os.mkdir(input_path)
+        if not os.path.isfile(os.path.join(input_path, input_name)):
+            link_or_copy(os.path.join(entry, input_name), os.path.join(input_path, input_name))
+        print('\nProduct %s restored from cache.' % product_id, flush=True)
+        return(input_name)
+    input_name = downloadproduct(api, product_id, directory, connections)
+    if input_name is None or not os.path.isfile(os.path.join(input_path, input_name)):
+        # another file of 'input' would silently be processed in place of the product
+        raise FileNotFoundError('Product %s is not available in %s, it is not online or was stored under a different name.'
+                                % (product_id, input_path))
+    if cache:
+        # the product is moved into the cache and linked back, it is only read from 'input'
+        entry = cache.put(key, [os.path.join(input_path, input_name)], product_id=product_id)
+        link_or_copy(os.path.join(entry, input_name), os.path.join(input_path, input_name))
+    return(input_name)
     
\ No newline at end of file
@@ -1,67 +1,236 @@
 import sys
-import json                                   # JSON encoder and decoder
 import os                                     # data access
+import json                                   # JSON encoder and decoder
 import shutil                                 # file operations
-import functools                              # higher-order functions and operations
-from osgeo import ogr, gdal, osr              # data conversion
-from sentinelsat.sentinel import SentinelAPI, read_geojson, geojson_to_wkt  # interface to Open Access Hub
-from processing import *
-from writeoutput import *
-from helperfunctions import *
-from showmaps import *
-from downloadimage import *
+import argparse                               # command line interface
+import multiprocessing                        # background refinement process
+# pipeline modules (SNAP, GDAL, geopandas, visualization) are imported inside mapflood on first use,
+# so importing this module has no side effects and headless runs skip the visualization libraries
 
 
-def mapflood(polarisations, dlinfo, showmaps):
-    directory = os.getcwd()
+# directory: working directory with 'AOI' subfolder, 'input' and 'output' are created in it (default: current directory)
+def mapflood(polarisations, dlinfo, showmaps, procinfo=None, directory=None):
+    if directory is None:
+        directory = os.getcwd()
+    if procinfo is None:
+        procinfo = {}
+    from sentinelsat.sentinel import SentinelAPI  # interface to Open Access Hub
+    from aoi import load_aoi
+    from helperfunctions import set_sourcebands, set_output_extensions
+    from downloadimage import get_first_product_id, get_covering_product_ids, prefetch_products
+    from profiling import StageProfiler
+    from cache import Cache
+    from catalog import Catalog
+    if showmaps:
+        from showmaps import plotdownloadmap, plotbasicmap, plotfloodmap
+    # optional per-stage profiling, 'materialise' forces evaluation of each lazy SNAP stage
+    profiler = StageProfiler(procinfo.get('profile', False), procinfo.get('materialise', False))
 
     try:
-        # get GeoJSON from either JSON, SHP, or KMZ file
-        data_json = readJSONFromAOI('%s/AOI' % directory)
+        # read GeoJSON, SHP, KML or KMZ file, parsed AOIs are cached by content hash
+        aoi = load_aoi('%s/AOI' % directory, os.path.join(procinfo['cache_dir'], 'aoi') if procinfo.get('cache_dir') else None)
     except FileNotFoundError:
         sys.exit('\nNo area of interest found. Please add one to the AOI map.')
+    data_json = aoi['geojson']
 
     # Download image
-    footprint = geojson_to_wkt(data_json)
+    # simplified footprint for search and subset, the exact AOI clips the flood mask
+    footprint = aoi['footprint']
     api = SentinelAPI(dlinfo['username'], dlinfo['password'], 'https://scihub.copernicus.eu/dhus')
 
-    firstproduct = get_first_product_id(api, footprint, dlinfo)
-    firstproduct_id = firstproduct[0]
-    firstproduct_json = firstproduct[1]
+    # local product catalog, so overlapping AOIs and re-runs only query new time ranges
+    catalog = Catalog(dlinfo['catalog']) if dlinfo.get('catalog') else None
+    if procinfo.get('monitoring') is not None:
+        # incremental mode: only passes which earlier runs have not processed, with delta products (see monitoring.py)
+        from monitoring import monitor
+        monitor(api, aoi, catalog, polarisations, dlinfo, procinfo, profiler, directory)
+        profiler.write(directory, 'monitoring', polarisations=polarisations, procinfo=procinfo)
+        return None
+    if dlinfo.get('multi_scene'):
+        # smallest set of slices of one pass covering the AOI
+        product_ids, firstproduct_json = get_covering_product_ids(api, footprint, dlinfo, catalog, dlinfo.get('offline', False))
+    else:
+        firstproduct = get_first_product_id(api, footprint, dlinfo, catalog, dlinfo.get('offline', False))
+        product_ids, firstproduct_json = [firstproduct[0]], firstproduct[1]
+    firstproduct_id = product_ids[0]
 
     if showmaps:
         plotdownloadmap(data_json, firstproduct_json)
 
-    downloadproduct(api, firstproduct_id, directory)
+    # local cache of products and intermediates, keyed by product UUID, AOI and stage parameters
+    cache = Cache(procinfo['cache_dir'], procinfo.get('cache_max_gb', 50)) if procinfo.get('cache_dir') else None
+    input_names = prefetch_products(api, product_ids, directory, cache, dlinfo.get('connections', 4), dlinfo.get('prefetch', 2))
+    # outputs are named after the first product
+    input_name = input_names[0]
     
-    # Prepare for processing
+    # Prepare for processing (starts the JVM)
+    from processing import configure_jai, read_products
+    from tiling import split_aoi, map_tiled
+    from writeoutput import write_vectors, make_output_folders, publish_outputs, default_formats
+    from auxdata import aoi_auxdata
     sourceBands = set_sourcebands(polarisations)
     out_ext = set_output_extensions(polarisations)
     input_path = os.path.join(directory, 'input')
-    input_name = get_input_name(input_path)
-    ### !!! MAKE SURE THAT ALWAYS THE RIGHT S1 PRODUCT IS USED (IN CASE THERE ARE MULTIPLE IN THE INPUT FILE)
-    S1_source = snappy.ProductIO.readProduct('%s/%s' % (input_path, input_name))
-    
+    input_files = ['%s/%s' % (input_path, name) for name in input_names]
+
     if showmaps:
-        plotbasicmap(S1_source, data_json)
+        # several slices are assembled into one product
+        plotbasicmap(read_products(input_files), data_json)
         
     # Image processing
-    S1_crop = make_subset(S1_source, footprint, sourceBands)
-    S1_Orb = apply_orbit_file(S1_crop)
-    S1_Thm = thermal_noise_removal(S1_Orb)
-    S1_Cal = radiometric_calibration(S1_Thm)
-    S1_Spk = speckle_filtering(S1_Cal)
-    S1_Spk_db = convert_to_db(S1_Spk)
-    S1_TC = terrain_correction(S1_Spk_db)
-    S1_floodMask = binarization(S1_TC, S1_Spk_db)
-    S1_floodMask_Spk = speckle_filtering(S1_floodMask)
-    
-    
-    # Wite output
-    writingoutput(S1_floodMask_Spk, directory, input_name, out_ext, polarisations)
+    configure_jai(procinfo.get('tile_cache_mb'), procinfo.get('parallelism'))
+    # DEM and GlobCover clipped from the local aux-data store instead of SNAP's on-demand downloads
+    aux = aoi_auxdata(footprint, procinfo['aux_dir'], dlinfo.get('offline', False)) if procinfo.get('aux_dir') else None
+    tiles = split_aoi(footprint, procinfo.get('max_tile_km2', 800), procinfo.get('tile_overlap_km', 1.0))
+    refinement = None
+    skipped = []
+    if len(tiles) > 1:
+        # large AOI: process overlapping tiles in parallel JVMs and mosaic masks into output GeoTIFF
+        formats = procinfo.get('formats') or default_formats
+        make_output_folders(directory, formats)
+        thresholds, skipped = profiler.run('tiled_processing', map_tiled, input_files, tiles, sourceBands,
+                                           directory, input_name, out_ext, procinfo, aux, aoi['exact'])
+        profiler.run('write_vectors', write_vectors, directory, input_name, out_ext, polarisations, formats)
+    elif procinfo.get('quicklook'):
+        # coarse preview (mask and GeoJSON) first, full resolution reuses its thresholds and replaces it
+        quicklook = procinfo['quicklook']
+        workdir = os.path.join(directory, 'intermediate', 'quicklook')
+        shutil.rmtree(os.path.join(workdir, 'output'), ignore_errors=True)
+        thresholds = map_aoi(input_files, product_ids, footprint, sourceBands, workdir, input_name, out_ext, polarisations,
+                             procinfo, profiler, cache, aux, pixel_spacing=quicklook.get('pixel_spacing', 60.0), formats=('GeoJSON',),
+                             clip=aoi['exact'])
+        publish_outputs(os.path.join(workdir, 'output'), os.path.join(directory, 'output'))
+        print('Quicklook stored under %s, full resolution follows.\n' % os.path.join(directory, 'output'), flush=True)
+        args = (input_files, product_ids, footprint, sourceBands, directory, input_name, out_ext, polarisations, procinfo, thresholds, aux, aoi['exact'])
+        if quicklook.get('background'):
+            # own process with its own JVM, so the preview can be used while the refinement runs
+            refinement = multiprocessing.get_context('spawn').Process(target=refine, args=args)
+            refinement.start()
+        else:
+            refine(*args)
+    else:
+        map_aoi(input_files, product_ids, footprint, sourceBands, directory, input_name, out_ext, polarisations,
+                procinfo, profiler, cache, aux, clip=aoi['exact'])
+    profiler.write(directory, os.path.splitext(input_name)[0], product_id=firstproduct_id,
+                   polarisations=polarisations, procinfo=procinfo, skipped_tiles=skipped)
 
     if showmaps:
         plotfloodmap(input_name, polarisations, directory, out_ext)
+    # running background refinement, callers can join() it
+    return refinement
+
+# run chain, binarization and mask filtering for an AOI processed as a whole, write outputs to <workdir>/output
+# returns thresholds used, see flood_mask for the other arguments
+def map_aoi(input_files, product_ids, footprint, sourceBands, workdir, input_name, out_ext, polarisations, procinfo,
+            profiler, cache=None, aux=None, thresholds=None, pixel_spacing=None, formats=None, clip=None):
+    from writeoutput import writingoutput, write_vectors, make_output_folders, default_formats
+    formats = formats or procinfo.get('formats') or default_formats
+    # the block engine streams the mask straight into the output GeoTIFF
+    output_file = None
+    if procinfo.get('block_engine') is not None and pixel_spacing is None:
+        output_file = '%s/GeoTIFF/%s_%s.tif' % (make_output_folders(workdir, formats), os.path.splitext(input_name)[0], out_ext)
+    S1_floodMask, S1_TC, thresholds = flood_mask(input_files, product_ids, footprint, sourceBands, workdir, input_name, procinfo,
+                                                 profiler, cache, aux, thresholds, pixel_spacing, clip, output_file=output_file)
+
+    # Wite output
+    stage = '%s' if pixel_spacing is None else 'quicklook_%s'
+    if output_file:
+        print('Exporting...\n', flush=True)
+        profiler.run('write_vectors', write_vectors, workdir, input_name, out_ext, polarisations, formats)
+    else:
+        profiler.run(stage % 'writingoutput', writingoutput, S1_floodMask, workdir, input_name, out_ext, polarisations,
+                     formats, procinfo.get('cog'))
+    return thresholds
+
+# run chain, binarization and mask filtering for an AOI processed as a whole, intermediates are kept below <workdir>
+# thresholds: precomputed threshold per band, e.g. of the quicklook, otherwise computed from the dB product
+# aux: DEM and GlobCover files of the local aux-data store (see auxdata.aoi_auxdata), None lets SNAP download them
+# pixel_spacing: coarse output pixel spacing in m of the quicklook, None for full resolution
+# clip: exact AOI (WKT), pixels outside of it are set to 0
+# land_cover: False skips the GlobCover exclusion of permanent water, e.g. when it is applied later on a fixed grid
+# output_file: GeoTIFF the block engine (procinfo['block_engine'], see blockengine.py) streams the mask into
+# returns uint8 mask dataset (in memory, or of output_file), stored terrain corrected product and thresholds used
+def flood_mask(input_files, product_ids, footprint, sourceBands, workdir, input_name, procinfo, profiler, cache=None, aux=None,
+               thresholds=None, pixel_spacing=None, clip=None, land_cover=True, output_file=None):
+    from processing import (operator_parameters, quicklook_parameters, external_dem_parameters, read_products, make_subset, apply_orbit_file,
+                            thermal_noise_removal, radiometric_calibration, speckle_filtering, convert_to_db,
+                            terrain_correction, get_thresholds, add_land_cover, binarization_stored)
+    from maskfilter import filter_flood_mask
+    from rasterstore import RasterStore
+    from aoi import clip_to_aoi
+    from snapgraph import run_cached_chain_graph, chain_cache_key
+    os.makedirs(workdir, exist_ok=True)
+    # dB, terrain corrected and land cover bands are materialised once and memory-mapped
+    store = RasterStore(os.path.join(workdir, 'intermediate', 'rasters', os.path.splitext(input_name)[0]))
+    stage = '%s' if pixel_spacing is None else 'quicklook_%s'
+    parameters = operator_parameters if pixel_spacing is None else quicklook_parameters(pixel_spacing)
+    if aux:
+        parameters = external_dem_parameters(parameters, aux['dem'])
+    if procinfo.get('single_pass') or pixel_spacing is not None:
+        # run subset to terrain correction as one graph, keeping dB and terrain corrected products on disk
+        S1_Spk_db, S1_TC = profiler.run(stage % 'single_pass_graph', run_cached_chain_graph, input_files,
+                                        footprint, sourceBands, os.path.join(workdir, 'intermediate'), cache,
+                                        chain_cache_key(product_ids, footprint, sourceBands, parameters), parameters)
+    else:
+        # several slices are assembled into one product
+        S1_source = read_products(input_files)
+        S1_crop = profiler.run('make_subset', make_subset, S1_source, footprint, sourceBands)
+        S1_Orb = profiler.run('apply_orbit_file', apply_orbit_file, S1_crop)
+        S1_Thm = profiler.run('thermal_noise_removal', thermal_noise_removal, S1_Orb)
+        S1_Cal = profiler.run('radiometric_calibration', radiometric_calibration, S1_Thm)
+        S1_Spk = profiler.run('speckle_filtering', speckle_filtering, S1_Cal)
+        S1_Spk_db = profiler.run('convert_to_db', convert_to_db, S1_Spk)
+        S1_Spk_db = profiler.run('store_Spk_db', store.materialise, S1_Spk_db, 'Spk_db')
+        # terrain correction reads the stored dB product instead of recomputing the chain
+        S1_TC = profiler.run('terrain_correction', terrain_correction, S1_Spk_db.product, parameters)
+    # products of the graph are BEAM-DIMAP files already and only mapped
+    S1_Spk_db = store.materialise(S1_Spk_db, 'Spk_db')
+    S1_TC = profiler.run(stage % 'store_TC', store.materialise, S1_TC, 'TC')
+    S1_LC = None
+    if land_cover:
+        S1_LC = profiler.run(stage % 'store_land_cover', store.materialise, add_land_cover(S1_TC.product, aux['landcover'] if aux else None),
+                             'land_cover', ['land_cover_GlobCover'])
+    if thresholds is None:
+        thresholds = profiler.run(stage % 'thresholds', get_thresholds, S1_Spk_db)
+    if output_file:
+        # binarization, mask filtering and clipping on blocks of the stored bands in a process pool
+        from osgeo import gdal
+        from blockengine import stream_flood_mask
+        from writeoutput import product_georeference
+        geotransform, projection = product_georeference(S1_TC.product)
+        profiler.run('block_engine', stream_flood_mask, [S1_TC.band_file(name) for name in S1_TC.getBandNames()],
+                     S1_TC.getBandNames(), S1_LC.band_file('land_cover_GlobCover') if S1_LC else None, thresholds,
+                     geotransform, projection, output_file, procinfo.get('mask_filter'), clip, procinfo.get('cog'),
+                     dict({'workers': procinfo.get('parallelism')}, **procinfo['block_engine']))
+        return gdal.Open(output_file), S1_TC, thresholds
+    S1_floodMask = profiler.run(stage % 'binarization', binarization_stored, S1_TC, S1_LC, thresholds)
+    # the 5x5 majority would cover several hundred metres on the coarse quicklook grid, which multilooking already smooths
+    if pixel_spacing is None:
+        S1_floodMask = profiler.run('mask_filtering', filter_flood_mask, S1_floodMask, procinfo.get('mask_filter'))
+    if clip:
+        S1_floodMask = profiler.run(stage % 'clip_to_aoi', clip_to_aoi, S1_floodMask, clip)
+    return S1_floodMask, S1_TC, thresholds
+
+# full resolution run with thresholds of the quicklook, outputs are staged and then replace the quicklook outputs
+# also the target of the background refinement process, so it sets up JAI, cache and profiler itself
+def refine(input_files, product_ids, footprint, sourceBands, directory, input_name, out_ext, polarisations, procinfo, thresholds, aux=None, clip=None):
+    from processing import configure_jai
+    from profiling import StageProfiler
+    from cache import Cache
+    from writeoutput import publish_outputs
+    configure_jai(procinfo.get('tile_cache_mb'), procinfo.get('parallelism'))
+    cache = Cache(procinfo['cache_dir'], procinfo.get('cache_max_gb', 50)) if procinfo.get('cache_dir') else None
+    profiler = StageProfiler(procinfo.get('profile', False), procinfo.get('materialise', False))
+    workdir = os.path.join(directory, 'intermediate', 'refine')
+    staging_path = os.path.join(workdir, 'output')
+    # no leftovers of an earlier run may be published
+    shutil.rmtree(staging_path, ignore_errors=True)
+    map_aoi(input_files, product_ids, footprint, sourceBands, workdir, input_name, out_ext, polarisations,
+            procinfo, profiler, cache, aux, thresholds, clip=clip)
+    publish_outputs(staging_path, os.path.join(directory, 'output'))
+    print('Full resolution flood map replaced quicklook.', flush=True)
+    profiler.write(directory, '%s_refine' % os.path.splitext(input_name)[0], product_id=product_ids[0],
+                   polarisations=polarisations, procinfo=procinfo)
 
         
 ################################################
@@ -76,10 +245,93 @@ dlinfo = {
     'period_start'      : [2022, 1, 15],           # format: [Year, Month, Day] e.g. DAY AFTER FLOOD HAPPENED 
     'period_stop'       : [2022, 1, 25],           # format: [Year, Month, Day] e.g. WEEK AFTER FLOOD HAPPENED
     'username'          : 'username',             # username for login
-    'password'          : 'password'              # password for login
+    'password'          : 'password',             # password for login
+    'connections'       : 4,                      # parallel connections per download
+    'prefetch'          : 2,                      # products downloaded at the same time, e.g. slices of one pass
+    'catalog'           : os.path.join(os.getcwd(), 'cache', 'catalog.sqlite'),  # local product catalog, None to always query the hub
+    'offline'           : False,                  # search local catalog only
+    'multi_scene'       : True                    # download and assemble all slices of one pass needed to cover the AOI
 }
 
 # show intermediate results if set to 'True'
 showmaps = True                               # 'True', 'False'
 
-mapflood(polarisations, dlinfo, showmaps)
\ No newline at end of file
+# SNAP execution settings
+procinfo = {
+    'single_pass'       : True,                   # run subset to terrain correction as one SNAP graph
+    'tile_cache_mb'     : 2048,                   # JAI tile cache size in MB, None keeps SNAP default
+    'parallelism'       : os.cpu_count(),         # JAI tile scheduler threads, None keeps SNAP default
+    'mask_type'         : 'uint8',                # 'uint8' (1/0, 0 = no-data) or 'float32' (1/NaN) binarization of AOI tiles
+    'cog'               : {'compress': 'DEFLATE', # write GeoTIFF as Cloud Optimized GeoTIFF, None for SNAP GeoTIFF
+                           'blocksize': 512,      # internal tile size in pixels
+                           'overviews': True},    # add overview pyramid
+    'max_tile_km2'      : 800,                    # AOIs larger than this are split into tiles processed in parallel
+    'tile_overlap_km'   : 1.0,                    # overlap between tiles, removed again when mosaicking
+    'tile_workers'      : None,                   # number of tile processes (one JVM each), None uses cores / 4
+    'tile_java_max_mem' : '4G',                   # maximum JVM heap per tile process
+    'cache_dir'         : os.path.join(os.getcwd(), 'cache'),  # cache for products and intermediates, None disables it
+    'cache_max_gb'      : 50,                     # cache size, least recently used entries are removed first
+    'profile'           : False,                  # write JSON trace of time and memory per stage to output/profile
+    'materialise'       : False,                  # force evaluation of each stage when profiling (slower, but real numbers)
+    'formats'           : ['SHP', 'KML', 'GeoJSON', 'FlatGeobuf', 'MBTiles'],  # vector outputs, also 'GPKG' and 'PMTiles' (GDAL 3.8)
+    'mask_filter'       : None,                   # mask post-processing, e.g. {'majority': 5, 'opening': 3, 'min_area': 50}, None: 5x5 majority (see maskfilter.py)
+    'aux_dir'           : os.path.join(os.getcwd(), 'auxdata'),  # local DEM and GlobCover store (see auxdata.py), None lets SNAP download them
+    'quicklook'         : None,                   # e.g. {'pixel_spacing': 60, 'background': True}: coarse preview first,
+                                                  # then full resolution with the preview thresholds (AOIs up to max_tile_km2)
+    'monitoring'        : None,                   # {} or settings (see monitoring.py): process only passes new since the last run
+                                                  # and write newly flooded / receded areas, the AOI is processed as a whole
+    'block_engine'      : None                    # {} or settings (see blockengine.py): binarization and mask filtering in a process pool,
+                                                  # streamed into the GeoTIFF, None keeps them in this process
+}
+
+# YYYY-MM-DD -> [Year, Month, Day]
+def parse_date(text):
+    return [int(part) for part in text.split('-')]
+
+# headless command line entry point, settings above are defaults which a JSON config file and arguments override
+# config file: {"polarisations": "VH", "showmaps": false, "dlinfo": {...}, "procinfo": {...}}
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Map flood extent from Sentinel-1 imagery for the AOI in <directory>/AOI.')
+    parser.add_argument('--config', help='JSON file with polarisations, showmaps, dlinfo and procinfo settings')
+    parser.add_argument('--directory', default=os.getcwd(), help="working directory with 'AOI' subfolder")
+    parser.add_argument('--polarisations', choices=['VH', 'VV', 'both'], help='polarisations to be processed')
+    parser.add_argument('--start', type=parse_date, help='start of sensing period, YYYY-MM-DD')
+    parser.add_argument('--stop', type=parse_date, help='end of sensing period, YYYY-MM-DD')
+    parser.add_argument('--username', default=os.environ.get('COPERNICUS_USERNAME'), help='hub username (default: $COPERNICUS_USERNAME)')
+    parser.add_argument('--password', default=os.environ.get('COPERNICUS_PASSWORD'), help='hub password (default: $COPERNICUS_PASSWORD)')
+    parser.add_argument('--offline', action='store_true', help='search local product catalog only')
+    parser.add_argument('--profile', action='store_true', help='write JSON trace of time and memory per stage')
+    parser.add_argument('--monitor', action='store_true', help='process only passes new since the last run and write delta products')
+    parser.add_argument('--showmaps', action='store_true', help='show interactive maps (needs a notebook)')
+    args = parser.parse_args(argv)
+
+    config = {'polarisations': polarisations, 'showmaps': False, 'dlinfo': dict(dlinfo), 'procinfo': dict(procinfo)}
+    if args.config:
+        with open(args.config, 'r') as f:
+            settings = json.load(f)
+        config['polarisations'] = settings.get('polarisations', config['polarisations'])
+        config['showmaps'] = settings.get('showmaps', config['showmaps'])
+        config['dlinfo'].update(settings.get('dlinfo', {}))
+        config['procinfo'].update(settings.get('procinfo', {}))
+    for key, value in [('period_start', args.start), ('period_stop', args.stop), ('username', args.username), ('password', args.password)]:
+        if value is not None:
+            config['dlinfo'][key] = value
+    if args.offline:
+        config['dlinfo']['offline'] = True
+    if args.profile:
+        config['procinfo']['profile'] = True
+    if args.monitor and config['procinfo'].get('monitoring') is None:
+        config['procinfo']['monitoring'] = {}
+    if args.polarisations:
+        config['polarisations'] = args.polarisations
+    config['showmaps'] = config['showmaps'] or args.showmaps
+
+    refinement = mapflood(config['polarisations'], config['dlinfo'], config['showmaps'], config['procinfo'], args.directory)
+    if refinement is not None:
+        refinement.join()
+        return refinement.exitcode
+    return 0
+
+# guard is needed because tile processes re-import this module
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
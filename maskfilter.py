@@ -0,0 +1,119 @@
+import os                                     # data access
+import time                                   # time assessment
+import numpy as np                            # scientific comupting
+from concurrent.futures import ThreadPoolExecutor  # chunk-parallel filtering
+
+# Post-processing of binary flood masks (uint8, 1 = flooded, 0 = not flooded) in NumPy.
+# All window operations use separable running sums of the 0/1 mask, so the cost per pixel does not depend
+# on the window size. The mask is processed in row chunks in parallel, each with a halo of rows above and
+# below, so the chunk results are identical to filtering the whole mask at once.
+
+# default post-processing: 5x5 majority, equal to SNAP's 5x5 Median Speckle-Filter on the binary mask
+mask_filter_defaults = {
+    'majority'    : 5,                        # window size of majority filter, 0 skips it
+    'opening'     : 0,                        # window size of morphological opening (removes small flooded specks)
+    'closing'     : 0,                        # window size of morphological closing (fills small gaps)
+    'min_area'    : 0,                        # flooded areas of fewer pixels are removed (minimum mapping unit)
+    'chunk_rows'  : 1024,                     # rows per chunk
+    'workers'     : None,                     # parallel chunks, None: as many as fit into memory_mb, at most one per core
+    'memory_mb'   : 1024                      # budget for the running sum temporaries of all chunks in flight
+}
+
+# bytes per pixel of a chunk while its window operations run: int32 cumulative sums and window counts
+chunk_bytes_per_pixel = 16
+
+# sum of values and number of pixels inside the image in a window of +-radius along axis
+def running_sum(counts, radius, axis):
+    n = counts.shape[axis]
+    shape = list(counts.shape)
+    shape[axis] = 1
+    # cumulative[i] is the sum of the first i values
+    cumulative = np.concatenate([np.zeros(shape, np.int32), np.cumsum(counts, axis=axis, dtype=np.int32)], axis=axis)
+    upper = np.minimum(np.arange(n) + radius + 1, n)
+    lower = np.maximum(np.arange(n) - radius, 0)
+    return np.take(cumulative, upper, axis=axis) - np.take(cumulative, lower, axis=axis), upper - lower
+
+# number of flooded pixels and of all pixels in the (2 * radius + 1)^2 window around each pixel
+# windows are cut at the array border
+def window_counts(mask, radius):
+    counts, rows = running_sum(mask, radius, 0)
+    counts, cols = running_sum(counts, radius, 1)
+    return counts, rows[:, None] * cols[None, :]
+
+# 1 where more than half of the window is flooded; for full windows the median of the 0/1 values
+def majority(mask, size):
+    counts, pixels = window_counts(mask, size // 2)
+    return (2 * counts > pixels).astype(np.uint8)
+
+def erosion(mask, size):
+    counts, pixels = window_counts(mask, size // 2)
+    return (counts == pixels).astype(np.uint8)
+
+def dilation(mask, size):
+    counts, pixels = window_counts(mask, size // 2)
+    return (counts > 0).astype(np.uint8)
+
+def opening(mask, size):
+    return dilation(erosion(mask, size), size)
+
+def closing(mask, size):
+    return erosion(dilation(mask, size), size)
+
+# window operations in order of application and how many halo rows each needs per window radius
+operations = [('majority', majority, 1), ('opening', opening, 2), ('closing', closing, 2)]
+
+# apply window operations to rows [y0, y1) of mask, reading halo rows around them
+def filter_chunk(mask, output, y0, y1, steps, halo):
+    top = max(0, y0 - halo)
+    chunk = mask[top:min(mask.shape[0], y1 + halo)]
+    for function, size in steps:
+        chunk = function(chunk, size)
+    output[y0:y1] = chunk[y0 - top:y0 - top + y1 - y0]
+
+# remove flooded areas (8-connected) of fewer than min_area pixels
+# connected areas can span any number of chunks, so this runs on the whole mask
+def remove_small_areas(mask, min_area):
+    import skimage.morphology                 # connected component filtering
+    return skimage.morphology.remove_small_objects(mask.astype(bool), min_size=min_area, connectivity=2).astype(np.uint8)
+
+# window operations (function, size) to apply and number of halo rows they need in total
+def window_steps(majority=5, opening=0, closing=0):
+    sizes = {'majority': majority, 'opening': opening, 'closing': closing}
+    steps = [(function, sizes[name]) for name, function, passes in operations if sizes[name] > 1]
+    halo = sum(passes * (sizes[name] // 2) for name, function, passes in operations if sizes[name] > 1)
+    return steps, halo
+
+# filter binary uint8 mask (2D array) with the settings of mask_filter_defaults, returns new array
+def filter_mask(mask, majority=5, opening=0, closing=0, min_area=0, chunk_rows=1024, workers=None, memory_mb=1024):
+    steps, halo = window_steps(majority, opening, closing)
+    mask = (mask == 1).astype(np.uint8)
+    if steps:
+        output = np.empty_like(mask)
+        h, w = mask.shape
+        # a full-width Sentinel-1 chunk needs several hundred MB, so all cores at once could exhaust memory
+        chunk_bytes = chunk_bytes_per_pixel * (min(chunk_rows, h) + 2 * halo) * w
+        workers = workers or max(1, min(os.cpu_count(), memory_mb * 1024**2 // chunk_bytes))
+        # NumPy releases the GIL in cumsum and comparisons, so threads run chunks in parallel
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda y0: filter_chunk(mask, output, y0, min(y0 + chunk_rows, h), steps, halo),
+                              range(0, h, chunk_rows)))
+        mask = output
+    if min_area > 1:
+        mask = remove_small_areas(mask, min_area)
+    return mask
+
+# filter every band of binarized in-memory uint8 dataset (see processing.binarization_stored) in place,
+# 'Product'-type input is read into such a dataset first
+# settings: dict overriding mask_filter_defaults, returns GDAL dataset (1 = flooded, 0 = no-data)
+def filter_flood_mask(S1_floodMask, settings=None):
+    from osgeo import gdal                    # in-memory datasets
+    from writeoutput import mask_dataset
+    print('7. Mask Filtering:            ', end='', flush=True)
+    start_time = time.time()
+    settings = dict(mask_filter_defaults, **(settings or {}))
+    mask_image = S1_floodMask if isinstance(S1_floodMask, gdal.Dataset) else mask_dataset(S1_floodMask)
+    for i in range(mask_image.RasterCount):
+        mask_band = mask_image.GetRasterBand(i + 1)
+        mask_band.WriteArray(filter_mask(mask_band.ReadAsArray(), **settings))
+    print('--- %.2f  seconds ---' % (time.time() - start_time), flush=True)
+    return mask_image
@@ -0,0 +1,213 @@
+import os                                     # data access
+import json                                   # JSON encoder and decoder
+import time                                   # time assessment
+import shutil                                 # file operations
+import numpy as np                            # scientific comupting
+from osgeo import ogr, gdal                   # monitoring grid
+from cache import cache_key
+
+# Incremental flood monitoring: repeated runs for the same AOI (e.g. after every Sentinel-1 pass during an event)
+# keep their state in <directory>/monitoring and only process passes which earlier runs have not processed yet.
+# Thresholds are reused per relative orbit, permanent water is taken from a GlobCover clip on a fixed grid, and
+# every pass is compared to the latest observation of each pixel, so a new pass only costs its own processing.
+#
+# <directory>/monitoring/state.json           processed passes, thresholds per relative orbit and monitoring grid
+# <directory>/monitoring/flood_state.tif      latest observation per pixel and band: 1 flooded, 0 dry, 255 never observed
+# <directory>/monitoring/permanent_water.tif  GlobCover permanent water (class 210) on the monitoring grid
+# <directory>/output/monitoring/<pass>/       flood mask, newly flooded and receded areas of each pass
+
+monitoring_defaults = {
+    'reuse_thresholds'  : True,                   # later passes of a relative orbit use the thresholds of its first pass
+    'min_coverage'      : 0.5,                    # passes covering a smaller fraction of the AOI are skipped
+    'formats'           : ['GeoJSON', 'FlatGeobuf']  # vector outputs of flood masks and delta products
+}
+
+# flood state value of pixels without observation, e.g. outside of the swath of all passes so far
+not_observed = 255
+
+def read_state(state_path, aoi_key):
+    file = os.path.join(state_path, 'state.json')
+    if os.path.isfile(file):
+        with open(file, 'r') as f:
+            state = json.load(f)
+        if state['aoi'] == aoi_key:
+            return state
+        # flood state and grid belong to the old AOI
+        print('AOI has changed, monitoring starts over.', flush=True)
+        shutil.rmtree(state_path)
+    os.makedirs(state_path, exist_ok=True)
+    return {'aoi': aoi_key, 'grid': None, 'latest': None, 'thresholds': {}, 'passes': {}}
+
+def write_state(state_path, state):
+    file = os.path.join(state_path, 'state.json')
+    with open(file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(file + '.tmp', file)
+
+# passes (see downloadimage.pass_names) of the sensing period which are not in state, oldest first
+# each with the smallest set of its products covering the AOI (see downloadimage.select_covering)
+def new_passes(api, footprint, dlinfo, catalog, state, min_coverage):
+    import shapely.wkt                        # geometric operations
+    from downloadimage import query_products, select_covering, pass_names
+    products = query_products(api, footprint, dlinfo, catalog, dlinfo.get('offline', False))
+    aoi = shapely.wkt.loads(footprint)
+    products_gdf = api.to_geodataframe(products)
+    products_gdf['pass'] = pass_names(products_gdf)
+    passes = []
+    for name, group in products_gdf.groupby('pass'):
+        if name in state['passes']:
+            continue
+        selected, covered = select_covering(group, aoi, 0.99)
+        if covered < min_coverage:
+            print('Pass %s covers %.1f%% of the AOI and is skipped.' % (name, 100 * covered), flush=True)
+            continue
+        group = group.loc[selected].sort_values('beginposition')
+        passes.append({'name'     : name,
+                       'products' : list(group['uuid']),
+                       'orbit'    : str(group['relativeorbitnumber'].iloc[0]),
+                       'sensing'  : group['beginposition'].iloc[0].isoformat(),
+                       'coverage' : covered})
+    return sorted(passes, key=lambda p: p['sensing'])
+
+# monitoring grid: envelope of the AOI in WGS84 with the pixel size of the first flood mask
+def make_grid(exact, mask_image):
+    minx, maxx, miny, maxy = ogr.CreateGeometryFromWkt(exact).GetEnvelope()
+    geotransform = mask_image.GetGeoTransform()
+    return {'bounds': [minx, miny, maxx, maxy], 'xres': abs(geotransform[1]), 'yres': abs(geotransform[5])}
+
+# in-memory copy of image on the monitoring grid, nearest neighbour keeps class values
+def warp_to_grid(image, grid, no_data=None):
+    return gdal.Warp('', image, format='MEM', dstSRS='EPSG:4326', outputBounds=grid['bounds'], xRes=grid['xres'],
+                     yRes=grid['yres'], targetAlignedPixels=True, resampleAlg='near', srcNodata=no_data, dstNodata=no_data)
+
+def read_bands(image):
+    return np.stack([image.GetRasterBand(i + 1).ReadAsArray() for i in range(image.RasterCount)])
+
+# in-memory uint8 dataset of arrays (bands x rows x columns) with georeference of template
+def grid_dataset(arrays, template, no_data=None):
+    image = gdal.GetDriverByName('MEM').Create('', template.RasterXSize, template.RasterYSize, len(arrays), gdal.GDT_Byte)
+    image.SetGeoTransform(template.GetGeoTransform())
+    image.SetProjection(template.GetProjectionRef())
+    for i, array in enumerate(arrays):
+        band = image.GetRasterBand(i + 1)
+        if no_data is not None:
+            band.SetNoDataValue(no_data)
+        if template.GetRasterBand(i + 1).GetDescription():
+            band.SetDescription(template.GetRasterBand(i + 1).GetDescription())
+        band.WriteArray(array.astype(np.uint8))
+    return image
+
+# flood mask (1/0) of pass on its own grid with not_observed where the terrain corrected band has no data,
+# so areas outside of the swath do not count as receded
+def observation_dataset(mask_image, S1_TC, block_rows=1024):
+    w, h = mask_image.RasterXSize, mask_image.RasterYSize
+    image = gdal.GetDriverByName('MEM').Create('', w, h, mask_image.RasterCount, gdal.GDT_Byte)
+    image.SetGeoTransform(mask_image.GetGeoTransform())
+    image.SetProjection(mask_image.GetProjectionRef())
+    for i in range(mask_image.RasterCount):
+        band = image.GetRasterBand(i + 1)
+        band.SetNoDataValue(not_observed)
+        band.SetDescription(mask_image.GetRasterBand(i + 1).GetDescription())
+        for y in range(0, h, block_rows):
+            rows = min(block_rows, h - y)
+            backscatter = S1_TC.getBandAt(i).window(y, rows)
+            observed = np.isfinite(backscatter) & (backscatter != 0)
+            flooded = mask_image.GetRasterBand(i + 1).ReadAsArray(0, y, w, rows)
+            band.WriteArray(np.where(observed, flooded, not_observed).astype(np.uint8), 0, y)
+    return image
+
+# permanent water of GlobCover clip on the monitoring grid, computed once per AOI
+def permanent_water(state_path, landcover_file, grid):
+    file = os.path.join(state_path, 'permanent_water.tif')
+    if not os.path.isfile(file):
+        land_cover = warp_to_grid(gdal.Open(landcover_file), grid)
+        water = read_bands(land_cover) == 210
+        gdal.GetDriverByName('GTiff').CreateCopy(file + '.tmp', grid_dataset(water, land_cover),
+                                                 options=['TILED=YES', 'COMPRESS=DEFLATE'])
+        os.replace(file + '.tmp', file)
+    return read_bands(gdal.Open(file))[0] == 1
+
+# compare observation of pass with the flood state (both bands x rows x columns on the monitoring grid)
+# returns new flood state, newly flooded and receded pixels; only pixels observed before and now are compared
+def update_flood_state(flood_state, observation):
+    observed = observation != not_observed
+    compared = observed & (flood_state != not_observed)
+    newly_flooded = compared & (flood_state == 0) & (observation == 1)
+    receded = compared & (flood_state == 1) & (observation == 0)
+    return np.where(observed, observation, flood_state), newly_flooded, receded
+
+# process all passes of the sensing period which earlier runs have not processed and write their flood masks
+# and delta products to <directory>/output/monitoring/<pass>; returns the updated state
+# aoi: parsed AOI (see aoi.load_aoi), settings in procinfo['monitoring'] override monitoring_defaults
+def monitor(api, aoi, catalog, polarisations, dlinfo, procinfo, profiler, directory):
+    from main import flood_mask
+    from processing import configure_jai
+    from downloadimage import prefetch_products
+    from helperfunctions import set_sourcebands, set_output_extensions
+    from writeoutput import writingoutput, publish_outputs
+    from auxdata import aoi_auxdata
+    from cache import Cache
+    settings = dict(monitoring_defaults, **(procinfo.get('monitoring') or {}))
+    state_path = os.path.join(directory, 'monitoring')
+    state = read_state(state_path, cache_key('aoi', aoi['exact'], polarisations))
+    passes = new_passes(api, aoi['footprint'], dlinfo, catalog, state, settings['min_coverage'])
+    if not passes:
+        print('No new Sentinel-1 passes since the last run.', flush=True)
+        return state
+    print('New Sentinel-1 passes: %s\n' % ', '.join(p['name'] for p in passes), flush=True)
+
+    cache = Cache(procinfo['cache_dir'], procinfo.get('cache_max_gb', 50)) if procinfo.get('cache_dir') else None
+    sourceBands = set_sourcebands(polarisations)
+    out_ext = set_output_extensions(polarisations)
+    configure_jai(procinfo.get('tile_cache_mb'), procinfo.get('parallelism'))
+    aux = aoi_auxdata(aoi['footprint'], procinfo['aux_dir'], dlinfo.get('offline', False)) if procinfo.get('aux_dir') else None
+    state_file = os.path.join(state_path, 'flood_state.tif')
+    for flood_pass in passes:
+        start_time = time.time()
+        name = flood_pass['name']
+        print('Pass %s (%s):' % (name, flood_pass['sensing']), flush=True)
+        input_names = prefetch_products(api, flood_pass['products'], directory, cache, dlinfo.get('connections', 4),
+                                        dlinfo.get('prefetch', 2))
+        input_files = [os.path.join(directory, 'input', input_name) for input_name in input_names]
+        orbit = flood_pass['orbit']
+        thresholds = state['thresholds'].get(orbit) if settings['reuse_thresholds'] else None
+        workdir = os.path.join(directory, 'intermediate', 'monitoring', name)
+        shutil.rmtree(workdir, ignore_errors=True)
+        # with the aux-data store, permanent water is excluded on the monitoring grid instead of per pass
+        mask_image, S1_TC, thresholds = flood_mask(input_files, flood_pass['products'], aoi['footprint'], sourceBands, workdir,
+                                                   input_names[0], procinfo, profiler, cache, aux, thresholds,
+                                                   clip=aoi['exact'], land_cover=aux is None)
+        if state['grid'] is None:
+            state['grid'] = make_grid(aoi['exact'], mask_image)
+        observation_image = warp_to_grid(observation_dataset(mask_image, S1_TC), state['grid'], not_observed)
+        observation = read_bands(observation_image)
+        if aux:
+            observation[(observation != not_observed) & permanent_water(state_path, aux['landcover'], state['grid'])] = 0
+
+        products = [('flood', observation == 1)]
+        info = {'products': flood_pass['products'], 'sensing': flood_pass['sensing'], 'coverage': flood_pass['coverage'],
+                'thresholds': [float(t) for t in thresholds], 'flooded_pixels': int((observation == 1).sum())}
+        # passes older than the latest processed one (late hub ingestion) are mapped but do not change the flood state
+        if state['latest'] is None or flood_pass['sensing'] > state['latest']:
+            flood_state = read_bands(gdal.Open(state_file)) if os.path.isfile(state_file) else np.full_like(observation, not_observed)
+            flood_state, newly_flooded, receded = update_flood_state(flood_state, observation)
+            if state['latest'] is not None:
+                products += [('newly_flooded', newly_flooded), ('receded', receded)]
+                info.update(newly_flooded_pixels=int(newly_flooded.sum()), receded_pixels=int(receded.sum()))
+            gdal.GetDriverByName('GTiff').CreateCopy(state_file + '.tmp', grid_dataset(flood_state, observation_image, not_observed),
+                                                     options=['TILED=YES', 'COMPRESS=DEFLATE'])
+            os.replace(state_file + '.tmp', state_file)
+            state['latest'] = flood_pass['sensing']
+
+        for product, array in products:
+            writingoutput(grid_dataset(array, observation_image, 0), workdir, '%s_%s' % (name, product), out_ext,
+                          polarisations, settings['formats'], procinfo.get('cog'))
+        publish_outputs(os.path.join(workdir, 'output'), os.path.join(directory, 'output', 'monitoring', name))
+        # the pass is done once it is in the state file, its intermediate rasters are not needed anymore
+        state['thresholds'].setdefault(orbit, info['thresholds'])
+        info['wall_s'] = time.time() - start_time
+        state['passes'][name] = info
+        write_state(state_path, state)
+        shutil.rmtree(workdir, ignore_errors=True)
+        print('Pass %s done --- %.2f seconds ---\n' % (name, info['wall_s']), flush=True)
+    return state
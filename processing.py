@@ -3,8 +3,77 @@ import time                                   # time assessment
 import numpy as np                            # scientific comupting
 import skimage.filters                        # threshold calculation
 import jpy                                    # Python-Java bridge
+import threading                              # serialised writes of parallel bands
+from concurrent.futures import ThreadPoolExecutor  # parallel bands
 from helperfunctions import plotBand
 
+# operator parameters shared by the stepwise chain and the single-pass graph (see snapgraph.py)
+operator_parameters = {
+    'Apply-Orbit-File'    : {'continueOnFail': True},       # continue with calculation in case no orbit file is available yet
+    'ThermalNoiseRemoval' : {'removeThermalNoise': True},
+    'Calibration'         : {'outputSigmaBand': True},
+    'Speckle-Filter'      : {'filter': 'Lee', 'filterSizeX': 5, 'filterSizeY': 5},
+    'LinearToFromdB'      : {},
+    'Terrain-Correction'  : {'demName': 'SRTM 1Sec HGT',
+                             'demResamplingMethod': 'BILINEAR_INTERPOLATION',
+                             'imgResamplingMethod': 'NEAREST_NEIGHBOUR',
+                             'pixelSpacingInMeter': 10.0,
+                             'nodataValueAtSea': False,
+                             'saveSelectedSourceBand': True}
+}
+
+# parameters of the quicklook chain: multilooking to about pixel_spacing before speckle filtering and
+# terrain correction at pixel_spacing, so every operator after calibration works on far fewer pixels
+# GRD pixels are 10 m, range looks give square ground pixels (azimuth looks follow)
+def quicklook_parameters(pixel_spacing=60.0):
+    parameters = dict(operator_parameters)
+    parameters['Multilook'] = {'nRgLooks': max(1, int(round(pixel_spacing / 10.0))),
+                               'outputIntensity': True,
+                               'grSquarePixel': True}
+    parameters['Terrain-Correction'] = dict(operator_parameters['Terrain-Correction'], pixelSpacingInMeter=float(pixel_spacing))
+    return(parameters)
+
+# use DEM of the local aux-data store (see auxdata.py) instead of SNAP's on-demand SRTM download
+# SRTM heights refer to the EGM96 geoid, so SNAP converts them to ellipsoid heights
+def external_dem_parameters(parameters, dem_file):
+    parameters = dict(parameters)
+    parameters['Terrain-Correction'] = dict(parameters['Terrain-Correction'], demName='External DEM',
+                                            externalDEMFile=dem_file, externalDEMNoDataValue=-32768.0,
+                                            externalDEMApplyEGM=True)
+    return(parameters)
+
+# parameters: operator parameters, default operator_parameters
+def make_parameters(operator, parameters=None):
+    if parameters is None:
+        parameters = operator_parameters
+    java_parameters = snappy.HashMap()
+    for key, value in parameters[operator].items():
+        # file parameters (e.g. externalDEMFile) are java.io.File
+        if key.endswith('File'):
+            value = jpy.get_type('java.io.File')(value)
+        java_parameters.put(key, value)
+    return(java_parameters)
+
+# configure JAI tile cache (MB) and tile scheduler parallelism of the running JVM
+def configure_jai(tile_cache_mb=None, parallelism=None):
+    JAI = jpy.get_type('javax.media.jai.JAI')
+    if tile_cache_mb:
+        JAI.getDefaultInstance().getTileCache().setMemoryCapacity(int(tile_cache_mb) * 1024 * 1024)
+    if parallelism:
+        JAI.getDefaultInstance().getTileScheduler().setParallelism(int(parallelism))
+
+# read product file, or list of consecutive slices of one pass which are assembled into one product
+def read_products(input_files):
+    S1_sources = [snappy.ProductIO.readProduct(file) for file in input_files]
+    if len(S1_sources) == 1:
+        return(S1_sources[0])
+    sourceProducts = jpy.array('org.esa.snap.core.datamodel.Product', len(S1_sources))
+    for i, S1_source in enumerate(S1_sources):
+        sourceProducts[i] = S1_source
+    S1_source = snappy.GPF.createProduct('SliceAssembly', snappy.HashMap(), sourceProducts)
+    print('\n%d slices assembled.' % len(S1_sources), flush=True)
+    return(S1_source)
+
 def make_subset(S1_source, footprint, sourceBands):
     parameters = snappy.HashMap()
     parameters.put('copyMetadata', True)
@@ -19,9 +88,7 @@ def make_subset(S1_source, footprint, sourceBands):
 def apply_orbit_file(S1_crop):
     print('1. Apply Orbit File:          ', end='', flush=True)
     start_time = time.time()
-    parameters = snappy.HashMap()
-    # continue with calculation in case no orbit file is available yet
-    parameters.put('continueOnFail', True)
+    parameters = make_parameters('Apply-Orbit-File')
     S1_Orb = snappy.GPF.createProduct('Apply-Orbit-File', parameters, S1_crop)
     print('--- %.2f  seconds ---' % (time.time() - start_time), flush=True)
     return(S1_Orb)
@@ -29,8 +96,7 @@ def apply_orbit_file(S1_crop):
 def thermal_noise_removal(S1_Orb):
     print('2. Thermal Noise Removal:     ', end='', flush=True)
     start_time = time.time()
-    parameters = snappy.HashMap()
-    parameters.put('removeThermalNoise', True)
+    parameters = make_parameters('ThermalNoiseRemoval')
     S1_Thm = snappy.GPF.createProduct('ThermalNoiseRemoval', parameters, S1_Orb)
     print('--- %.2f  seconds ---' % (time.time() - start_time), flush=True)
     return(S1_Thm)
@@ -38,8 +104,7 @@ def thermal_noise_removal(S1_Orb):
 def radiometric_calibration(S1_Thm):
     print('3. Radiometric Calibration:   ', end='', flush=True)
     start_time = time.time()
-    parameters = snappy.HashMap()
-    parameters.put('outputSigmaBand', True)
+    parameters = make_parameters('Calibration')
     S1_Cal = snappy.GPF.createProduct('Calibration', parameters, S1_Thm)
     print('--- %.2f  seconds ---' % (time.time() - start_time), flush=True)
     return(S1_Cal)
@@ -47,63 +112,121 @@ def radiometric_calibration(S1_Thm):
 def speckle_filtering(S1_Cal):
     print('4. Speckle Filtering:         ', end='', flush=True)
     start_time = time.time()
-    parameters = snappy.HashMap()
-    parameters.put('filter', 'Lee')
-    parameters.put('filterSizeX', 5)
-    parameters.put('filterSizeY', 5)
+    parameters = make_parameters('Speckle-Filter')
     S1_Spk = snappy.GPF.createProduct('Speckle-Filter', parameters, S1_Cal)
     print('--- %.2f  seconds ---' % (time.time() - start_time), flush=True)
     return(S1_Spk)
 
 def convert_to_db(S1_Spk):
     # Conversion from linear to db operator
-    S1_Spk_db = snappy.GPF.createProduct('LinearToFromdB', snappy.HashMap(), S1_Spk)
+    S1_Spk_db = snappy.GPF.createProduct('LinearToFromdB', make_parameters('LinearToFromdB'), S1_Spk)
     return(S1_Spk_db)
 
-def terrain_correction(S1_Spk_db):
+def terrain_correction(S1_Spk_db, parameters=None):
     # Terrain-Correction operator
     print('5. Terrain Correction:        ', end='', flush=True)
     start_time = time.time()
-    parameters = snappy.HashMap()
-    parameters.put('demName', 'SRTM 1Sec HGT')
-    parameters.put('demResamplingMethod', 'BILINEAR_INTERPOLATION')
-    parameters.put('imgResamplingMethod', 'NEAREST_NEIGHBOUR')
-    parameters.put('pixelSpacingInMeter', 10.0)
-    parameters.put('nodataValueAtSea', False)
-    parameters.put('saveSelectedSourceBand', True)
+    parameters = make_parameters('Terrain-Correction', parameters)
     S1_TC = snappy.GPF.createProduct('Terrain-Correction', parameters, S1_Spk_db)
     print('--- %.2f  seconds ---' % (time.time() - start_time), flush=True)
     return(S1_TC)
 
-# calculate and return threshold of 'Band'-type input
+# read 'Band'-type input in blocks of full rows to keep memory bounded
 # SNAP API: https://step.esa.int/docs/v6.0/apidoc/engine/
-def getThreshold(S1_band):
-    # read band
+# bands of the raster store (see rasterstore.py) are read as views of the memory-mapped file without copying
+def read_band_blocks(S1_band, block_rows=512):
     w = S1_band.getRasterWidth()
     h = S1_band.getRasterHeight()
-    band_data = np.zeros(w * h, np.float32)
-    S1_band.readPixels(0, 0, w, h, band_data)
-    band_data.shape = h * w
+    band_data = np.zeros(w * min(block_rows, h), np.float32)
+    for y in range(0, h, block_rows):
+        rows = min(block_rows, h - y)
+        if hasattr(S1_band, 'window'):
+            block = S1_band.window(y, rows)
+            yield block[np.isfinite(block)]
+            continue
+        # smaller buffer for the last block
+        if rows * w != band_data.size:
+            band_data = np.zeros(w * rows, np.float32)
+        S1_band.readPixels(0, y, w, rows, band_data)
+        # ignore no-data pixels which would break the histogram
+        yield band_data[np.isfinite(band_data)]
+
+# dB range of the fixed-bin histograms, with 256 * 64 fine bins one bin is about 0.004 dB wide
+# values outside are clamped into the first or last bin, so every band is binned in a single pass
+# and histograms of several tiles can be summed
+histogram_range = (-50.0, 20.0)
+
+# build fixed-bin histogram of 'Band'-type input without holding the full band in memory
+# the band is read once, in row blocks, into nbins * subbins fine bins over value_range
+def get_band_histogram(S1_band, nbins=256, subbins=64, block_rows=512, value_range=histogram_range):
+    return get_band_histograms([S1_band], nbins, subbins, block_rows, value_range)[0]
+
+# like get_band_histogram for several bands of the same product (e.g. VH and VV) in one pass:
+# the row blocks of all bands are read one after another on the calling thread, so SNAP computes the shared
+# source tiles once, only the binning of the blocks runs concurrently for all bands
+def get_band_histograms(S1_bands, nbins=256, subbins=64, block_rows=512, value_range=histogram_range):
+    vmin, vmax = value_range
+    counts = [np.zeros(nbins * subbins, np.int64) for S1_band in S1_bands]
+    with ThreadPoolExecutor(max_workers=len(S1_bands)) as executor:
+        for blocks in zip(*[read_band_blocks(S1_band, block_rows) for S1_band in S1_bands]):
+            for band_counts, block_counts in zip(counts, executor.map(
+                    lambda block: np.histogram(np.clip(block, vmin, vmax), bins=nbins * subbins, range=value_range)[0], blocks)):
+                band_counts += block_counts
+    edges = np.linspace(vmin, vmax, nbins * subbins + 1)
+    return [(band_counts, edges) for band_counts in counts]
+
+# rebin fine histogram to nbins over the range of its non-empty bins in [lower, upper)
+# mirrors skimage.exposure.histogram on the corresponding subset of pixels
+def rebin_histogram(counts, edges, nbins=256, lower=-np.inf, upper=np.inf):
+    centers = (edges[:-1] + edges[1:]) / 2
+    selected = (centers >= lower) & (centers < upper) & (counts > 0)
+    hist, bin_edges = np.histogram(centers[selected], bins=nbins, weights=counts[selected],
+                                   range=(centers[selected].min(), centers[selected].max()))
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    return hist, bin_centers
+
+# get number of pixels with values closer than 'distance' to threshold
+def count_near(counts, edges, threshold, distance=0.1):
+    centers = (edges[:-1] + edges[1:]) / 2
+    return counts[abs(centers - threshold) < distance].sum()
+
+# calculate and return threshold of 'Band'-type input
+# band is streamed in row blocks into one histogram, all thresholds and counts derive from it
+# SNAP API: https://step.esa.int/docs/v6.0/apidoc/engine/
+def getThreshold(S1_band, nbins=256, block_rows=512):
+    # read band into fine histogram
+    counts, edges = get_band_histogram(S1_band, nbins=nbins, block_rows=block_rows)
+    return threshold_from_histogram(counts, edges, nbins)
+
+# threshold of every band of 'Product'-type input, e.g. computed on the quicklook and reused at full resolution
+# all bands are binned in one pass, selecting a threshold from a histogram is cheap and runs on the calling thread
+def get_thresholds(S1_Spk_db, nbins=256, block_rows=512):
+    histograms = get_band_histograms([S1_Spk_db.getBandAt(i) for i in range(S1_Spk_db.getNumBands())],
+                                     nbins=nbins, block_rows=block_rows)
+    return(np.array([threshold_from_histogram(counts, edges, nbins) for counts, edges in histograms]))
+
+# select Otsu or minimum threshold from fine histogram (see get_band_histogram)
+def threshold_from_histogram(counts, edges, nbins=256):
+    hist = rebin_histogram(counts, edges, nbins)
 
     # calculate threshold using Otsu method
-    threshold_otsu = skimage.filters.threshold_otsu(band_data)
+    threshold_otsu = skimage.filters.threshold_otsu(hist=hist)
     # calculate threshold using minimum method
-    threshold_minimum = skimage.filters.threshold_minimum(band_data)
+    threshold_minimum = skimage.filters.threshold_minimum(hist=hist)
     # get number of pixels for both thresholds
-    numPixOtsu = len(band_data[abs(band_data - threshold_otsu) < 0.1])
-    numPixMinimum = len(band_data[abs(band_data - threshold_minimum) < 0.1])
+    numPixOtsu = count_near(counts, edges, threshold_otsu)
+    numPixMinimum = count_near(counts, edges, threshold_minimum)
 
     # if number of pixels at minimum threshold is less than 1% of number of pixels at Otsu threshold
     if abs(numPixMinimum/numPixOtsu) < 0.001: #this can cause zero division error
-        # adjust band data according
+        # adjust histogram according
         if threshold_otsu < threshold_minimum:
-            band_data = band_data[band_data < threshold_minimum]
-            threshold_minimum = skimage.filters.threshold_minimum(band_data)
+            hist = rebin_histogram(counts, edges, nbins, upper=threshold_minimum)
         else:
-            band_data = band_data[band_data > threshold_minimum]
-            threshold_minimum = skimage.filters.threshold_minimum(band_data)
-    
-        numPixMinimum = len(band_data[abs(band_data - threshold_minimum) < 0.1])
+            hist = rebin_histogram(counts, edges, nbins, lower=threshold_minimum)
+        threshold_minimum = skimage.filters.threshold_minimum(hist=hist)
+
+        numPixMinimum = count_near(counts, edges, threshold_minimum)
 
     # select final threshold
     if abs(numPixMinimum/numPixOtsu) < 0.001:
@@ -113,7 +236,8 @@ def getThreshold(S1_band):
     return threshold
 
 # calculate binary mask of 'Product'-type intput with respect expression in string array
-def binarize(S1_product, expressions):
+# mask_type 'uint8' stores 1/0 instead of float32 1/NaN
+def binarize(S1_product, expressions, mask_type='float32'):
     BandDescriptor = jpy.get_type('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor')
     targetBands = jpy.array('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor', len(expressions))
 
@@ -121,7 +245,7 @@ def binarize(S1_product, expressions):
     for i in range(len(expressions)):
         targetBand = BandDescriptor()
         targetBand.name = '%s' % S1_product.getBandNames()[i]
-        targetBand.type = 'float32'
+        targetBand.type = mask_type
         targetBand.expression = expressions[i]
         targetBands[i] = targetBand
         
@@ -130,46 +254,86 @@ def binarize(S1_product, expressions):
     mask = snappy.GPF.createProduct('BandMaths', parameters, S1_product)
     return mask
 
-def binarization(S1_TC, S1_Spk_db):
+# add GlobCover band 'land_cover_GlobCover' to 'Product'-type input
+# land_cover_file: GlobCover clip of the local aux-data store (see auxdata.py), None lets SNAP download GlobCover
+def add_land_cover(S1_TC, land_cover_file=None):
+    parameters = snappy.HashMap()
+    if land_cover_file is None:
+        parameters.put('landCoverNames', 'GlobCover')
+    else:
+        # band of external land cover is named after the file, i.e. land_cover_GlobCover
+        externalFiles = jpy.array('java.io.File', 1)
+        externalFiles[0] = jpy.get_type('java.io.File')(land_cover_file)
+        parameters.put('landCoverNames', jpy.array('java.lang.String', 0))
+        parameters.put('externalFiles', externalFiles)
+    return(snappy.GPF.createProduct('AddLandCover', parameters, S1_TC))
+
+# thresholds: optional precomputed threshold per band, e.g. shared across AOI tiles
+def binarization(S1_TC, S1_Spk_db, mask_type='uint8', thresholds=None, land_cover_file=None):
     # Binarization
     print('6. Binarization:              ', end='', flush=True)
     start_time = time.time()
-    # add GlobCover band
-    parameters = snappy.HashMap()
-    parameters.put('landCoverNames', 'GlobCover')
-    GlobCover = snappy.GPF.createProduct('AddLandCover', parameters, S1_TC)
+    GlobCover = add_land_cover(S1_TC, land_cover_file)
     # empty string array for binarization band maths expression(s)
     expressions = ['' for i in range(S1_TC.getNumBands())]
+    # value of non-flooded pixels
+    not_flooded = '0' if mask_type == 'uint8' else 'NaN'
     # empty array for threshold(s)
-    thresholds = np.zeros(S1_TC.getNumBands())
+    if thresholds is None:
+        thresholds = np.full(S1_TC.getNumBands(), np.nan)
+    else:
+        thresholds = np.array(thresholds, dtype=float)
+    # calculate missing thresholds of all bands in one pass
+    # use S1_Spk_db product for performance reasons. S1_TC causes 0-values
+    # which distort histogram and thus threshold result
+    if np.isnan(thresholds).any():
+        thresholds = np.where(np.isnan(thresholds), get_thresholds(S1_Spk_db), thresholds)
     # loop through bands
     for i in range(S1_TC.getNumBands()):
-        # calculate threshold of band and store in float array
-        # use S1_Spk_db product for performance reasons. S1_TC causes 0-values
-        # which distort histogram and thus threshold result
-        thresholds[i] = getThreshold(S1_Spk_db.getBandAt(i))
         # formulate expression according to threshold and store in string array
-        expressions[i] = 'if (%s < %s && land_cover_GlobCover != 210) then 1 else NaN' % (S1_TC.getBandNames()[i], thresholds[i])
+        expressions[i] = 'if (%s < %s && land_cover_GlobCover != 210) then 1 else %s' % (S1_TC.getBandNames()[i], thresholds[i], not_flooded)
     # do binarization
-    S1_floodMask = binarize(GlobCover, expressions)
+    # flood mask is filtered next (see maskfilter.py), which needs the 0 pixels
+    S1_floodMask = binarize(GlobCover, expressions, mask_type)
     print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
     return(S1_floodMask)
 
-def speckle_filtering(S1_floodMask):
-    # Speckle-Filter operator
-    print('7. Speckle Filtering:         ', end='', flush=True)
+# binarization of stored terrain corrected bands and land cover (see rasterstore.py) in row blocks
+# returns in-memory uint8 dataset, 1 where band < threshold outside of permanent water (GlobCover class 210)
+# S1_LC None skips the permanent water exclusion
+def binarization_stored(S1_TC, S1_LC, thresholds, block_rows=1024):
+    from osgeo import gdal                    # data conversion
+    from writeoutput import product_georeference
+    print('6. Binarization:              ', end='', flush=True)
     start_time = time.time()
-    parameters = snappy.HashMap()
-    parameters.put('filter', 'Median')
-    parameters.put('filterSizeX', 5)
-    parameters.put('filterSizeY', 5)
-    # define flood mask as global for later access
-    # global S1_floodMask_Spk
-    S1_floodMask_Spk = snappy.GPF.createProduct('Speckle-Filter', parameters, S1_floodMask)
-    print('--- %.2f  seconds ---' % (time.time() - start_time), flush=True)
-    return(S1_floodMask_Spk)
+    w, h = S1_TC.getSceneRasterWidth(), S1_TC.getSceneRasterHeight()
+    geotransform, projection = product_georeference(S1_TC.product)
+    mask_image = gdal.GetDriverByName('MEM').Create('', w, h, S1_TC.getNumBands(), gdal.GDT_Byte)
+    mask_image.SetGeoTransform(geotransform)
+    mask_image.SetProjection(projection)
+    land_cover = S1_LC.getBandAt(0) if S1_LC is not None else None
+    # bands are binarized in parallel, GDAL datasets only allow one writer at a time
+    lock = threading.Lock()
+    def binarize_band(i):
+        mask_band = mask_image.GetRasterBand(i + 1)
+        for y in range(0, h, block_rows):
+            rows = min(block_rows, h - y)
+            # comparisons are false for NaN, the no-data value 0 dB lies above any threshold
+            flooded = S1_TC.getBandAt(i).window(y, rows) < thresholds[i]
+            if land_cover is not None:
+                flooded &= land_cover.window(y, rows) != 210
+            with lock:
+                mask_band.WriteArray(flooded.astype(np.uint8), 0, y)
+    for i in range(S1_TC.getNumBands()):
+        mask_band = mask_image.GetRasterBand(i + 1)
+        mask_band.SetNoDataValue(0)
+        mask_band.SetDescription(S1_TC.getBandNames()[i])
+    with ThreadPoolExecutor(max_workers=S1_TC.getNumBands()) as executor:
+        list(executor.map(binarize_band, range(S1_TC.getNumBands())))
+    print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
+    return(mask_image)
 
-def plotresults(S1_TC):
+def plotresults(S1_TC, thresholds):
     print('8. Plot:                      ', end='', flush=True)
     start_time = time.time()
     for i in range(S1_TC.getNumBands()):
@@ -0,0 +1,115 @@
+import os                                     # data access
+import json                                   # JSON encoder and decoder
+import time                                   # time assessment
+import resource                               # peak memory of process
+
+# current resident set size and I/O counters of this process (Linux /proc, None elsewhere)
+def read_proc_stats():
+    stats = {'rss_mb': None, 'read_bytes': None, 'write_bytes': None}
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            stats['rss_mb'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in ('read_bytes', 'write_bytes'):
+                    stats[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return stats
+
+# reset the peak RSS (VmHWM) of this process to its current RSS, False if the kernel does not allow it
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+# peak RSS (VmHWM) since the last reset_peak_rss, None where /proc is not available
+def read_peak_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    # reported in kB
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def jvm_heap_used_mb():
+    import jpy                                # Python-Java bridge
+    runtime = jpy.get_type('java.lang.Runtime').getRuntime()
+    return (runtime.totalMemory() - runtime.freeMemory()) / 1024**2
+
+def snapshot():
+    stats = read_proc_stats()
+    stats['wall'] = time.time()
+    stats['cpu'] = time.process_time()
+    # lifetime high-water mark of the process, ru_maxrss is reported in KB on Linux
+    stats['process_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    stats['jvm_heap_mb'] = jvm_heap_used_mb()
+    return stats
+
+# force computation of lazy 'Product'-type input by reading every band once
+def materialise(product, block_rows=512):
+    from processing import read_band_blocks
+    for i in range(product.getNumBands()):
+        for block in read_band_blocks(product.getBandAt(i), block_rows):
+            pass
+
+def difference(after, before, key):
+    if after[key] is None or before[key] is None:
+        return None
+    return after[key] - before[key]
+
+# records wall time, CPU time, memory and I/O of each processing stage and writes them as JSON trace
+# GPF.createProduct is lazy, so stages are only measured meaningfully with materialise=True
+class StageProfiler:
+    def __init__(self, enabled=True, materialise=False):
+        self.enabled = enabled
+        self.materialise = materialise
+        self.stages = []
+        self.start = time.time()
+
+    def run(self, name, function, *args, **kwargs):
+        if not self.enabled:
+            return function(*args, **kwargs)
+        before = snapshot()
+        # peak_rss_mb of the stage is only known if the high-water mark can be reset, None otherwise
+        stage_peak = reset_peak_rss()
+        result = function(*args, **kwargs)
+        if self.materialise:
+            for product in (result if isinstance(result, tuple) else (result,)):
+                if hasattr(product, 'getNumBands'):
+                    materialise(product)
+        after = snapshot()
+        self.stages.append({'stage'         : name,
+                            'materialised'  : self.materialise,
+                            'wall_s'        : after['wall'] - before['wall'],
+                            'cpu_s'         : after['cpu'] - before['cpu'],
+                            'rss_mb'        : after['rss_mb'],
+                            'peak_rss_mb'   : read_peak_rss_mb() if stage_peak else None,
+                            'process_peak_rss_mb': after['process_peak_rss_mb'],
+                            'jvm_heap_mb'   : after['jvm_heap_mb'],
+                            'jvm_heap_delta_mb': after['jvm_heap_mb'] - before['jvm_heap_mb'],
+                            'read_bytes'    : difference(after, before, 'read_bytes'),
+                            'write_bytes'   : difference(after, before, 'write_bytes')})
+        return result
+
+    def write(self, directory, name, **run_info):
+        if not self.enabled:
+            return None
+        profile_path = os.path.join(directory, 'output', 'profile')
+        os.makedirs(profile_path, exist_ok=True)
+        trace = dict(run_info)
+        trace['started'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start))
+        trace['total_wall_s'] = time.time() - self.start
+        trace['stages'] = self.stages
+        file = os.path.join(profile_path, '%s_%s.json' % (name, time.strftime('%Y%m%d_%H%M%S', time.localtime(self.start))))
+        with open(file, 'w') as f:
+            json.dump(trace, f, indent=2)
+        print('Profile written to %s.' % file, flush=True)
+        return file
@@ -0,0 +1,107 @@
+import os                                     # data access
+import shutil                                 # file operations
+import numpy as np                            # scientific comupting
+
+# On-disk store of intermediate products: every product is materialised once as BEAM-DIMAP and its band files
+# are memory-mapped. Thresholds, binarization, plotting and QA read zero-copy windows of the mapped bands,
+# downstream SNAP operators read the stored product, so upstream operators never run twice per scene.
+# Products which already are BEAM-DIMAP files (e.g. written by the single-pass graph) are mapped in place.
+
+# NumPy types of the ENVI data types used for BEAM-DIMAP band files
+envi_types = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 12: 'u2', 13: 'u4', 14: 'i8', 15: 'u8'}
+
+def read_envi_header(file):
+    header = {}
+    with open(file, 'r') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                header[key.strip()] = value.strip()
+    return header
+
+# read-only memory map (rows x columns) of band file of BEAM-DIMAP product, SNAP writes big-endian by default
+def map_band_file(img_file):
+    header = read_envi_header(os.path.splitext(img_file)[0] + '.hdr')
+    byte_order = '>' if header.get('byte order', '1') == '1' else '<'
+    return np.memmap(img_file, dtype=np.dtype(byte_order + envi_types[int(header['data type'])]), mode='r',
+                     offset=int(header.get('header offset', 0)), shape=(int(header['lines']), int(header['samples'])))
+
+# 'Band'-like access to a memory-mapped band, window returns views without copying
+class StoredBand:
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def getName(self):
+        return self.name
+
+    def getRasterWidth(self):
+        return self.data.shape[1]
+
+    def getRasterHeight(self):
+        return self.data.shape[0]
+
+    # SNAP Band API, copies into the caller's buffer
+    def readPixels(self, x, y, w, h, array):
+        array[:w * h] = self.data[y:y + h, x:x + w].ravel()
+        return array
+
+    def window(self, y, rows, x=0, cols=None):
+        return self.data[y:y + rows, x:self.data.shape[1] if cols is None else x + cols]
+
+# 'Product'-like access to the mapped bands of a stored product
+# product is the SNAP product read from the stored file, the source for further SNAP operators
+class StoredProduct:
+    def __init__(self, product, file):
+        self.product = product
+        self.file = file
+        self.bands = [StoredBand(name, map_band_file(self.band_file(name))) for name in product.getBandNames()]
+
+    # ENVI band file of band, also readable by GDAL
+    def band_file(self, name):
+        return os.path.join(os.path.splitext(self.file)[0] + '.data', '%s.img' % name)
+
+    def getNumBands(self):
+        return len(self.bands)
+
+    def getBandAt(self, index):
+        return self.bands[index]
+
+    def getBandNames(self):
+        return [band.getName() for band in self.bands]
+
+    def getSceneRasterWidth(self):
+        return self.bands[0].getRasterWidth()
+
+    def getSceneRasterHeight(self):
+        return self.bands[0].getRasterHeight()
+
+# True if 'Product'-type input was read from a BEAM-DIMAP file, i.e. all its bands are on disk
+def is_dimap_file(product):
+    reader = product.getProductReader()
+    location = product.getFileLocation()
+    return (reader is not None and location is not None and str(location.getPath()).endswith('.dim')
+            and 'Dimap' in reader.getClass().getSimpleName())
+
+class RasterStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    # write 'Product'-type input (optionally only band_names) as <root>/<name>.dim and map its bands
+    def materialise(self, product, name, band_names=None):
+        import snappy                         # SNAP Python interface
+        if isinstance(product, StoredProduct):
+            return product
+        if band_names is None and is_dimap_file(product):
+            return StoredProduct(product, str(product.getFileLocation().getPath()))
+        if band_names is not None:
+            parameters = snappy.HashMap()
+            parameters.put('copyMetadata', True)
+            parameters.put('sourceBands', ','.join(band_names))
+            product = snappy.GPF.createProduct('Subset', parameters, product)
+        file = os.path.join(self.root, '%s.dim' % name)
+        # no band files of an earlier run may remain
+        shutil.rmtree(os.path.splitext(file)[0] + '.data', ignore_errors=True)
+        snappy.ProductIO.writeProduct(product, file, 'BEAM-DIMAP')
+        return StoredProduct(snappy.ProductIO.readProduct(file), file)
@@ -0,0 +1,226 @@
+import os                                     # data access
+import sys
+import json                                   # JSON encoder and decoder
+import time                                   # time assessment
+import uuid                                   # job ids
+import argparse                               # command line interface
+import atexit                                 # worker shutdown
+import threading                              # status collector
+import multiprocessing                        # warm worker processes
+import multiprocessing.connection             # worker exit detection
+from socketserver import ThreadingMixIn, UnixStreamServer
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Long-lived flood mapping service: a pool of worker processes keeps SNAP's JVM and operator registry warm,
+# queued jobs go to the next idle worker. Local job API (JSON over HTTP or a Unix socket):
+#   POST /jobs                      {"aoi": <GeoJSON>, "period_start": [2022, 1, 15], "period_stop": [2022, 1, 25], "polarisations": "VH"}
+#   GET  /jobs                      list of jobs and their status
+#   GET  /jobs/<id>                 status and timings of job
+#   GET  /jobs/<id>/outputs         list of output files
+#   GET  /jobs/<id>/outputs/<file>  download output file
+# Usage: python service.py --workers 2 --port 8080   or   python service.py --socket /tmp/floodmapping.sock
+
+# worker process: start JVM and load SNAP operators once, then process jobs until None is received
+def worker(jobs, events, dlinfo, procinfo):
+    import snappy                             # SNAP Python interface
+    from main import mapflood
+    from tiling import skipped_tiles
+    snappy.GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
+    for job in iter(jobs.get, None):
+        events.put(('running', job['id'], {'started': time.time(), 'worker': os.getpid()}))
+        result = {'status': 'done', 'error': None}
+        try:
+            mapflood(job.get('polarisations', 'VH'), dict(dlinfo, **job['dlinfo']), False,
+                     dict(procinfo, **job['procinfo']), directory=job['workdir'])
+            # tiles of large AOIs which failed are gaps in the flood mask
+            result['skipped_tiles'] = skipped_tiles(job['workdir'])
+        except SystemExit as e:
+            result.update(status='failed', error=str(e).strip())
+        except Exception as e:
+            result.update(status='failed', error='%s: %s' % (type(e).__name__, e))
+        result['finished'] = time.time()
+        events.put(('finished', job['id'], result))
+
+class Service:
+    def __init__(self, root, workers, dlinfo, procinfo):
+        self.root = root
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.dlinfo = dlinfo
+        # JAI threads are shared between workers
+        self.procinfo = dict(procinfo, parallelism=max(1, os.cpu_count() // workers))
+        # worker pid -> id of the job it is running, pids of workers which have exited
+        self.running = {}
+        self.exited = set()
+        self.closing = False
+        self.context = multiprocessing.get_context('spawn')
+        self.queue = self.context.Queue()
+        self.events = self.context.Queue()
+        # not daemonic, so jobs can start their own processes (tiles, background refinement, block engine)
+        self.workers = [self.start_worker() for i in range(workers)]
+        threading.Thread(target=self.collect, daemon=True).start()
+        threading.Thread(target=self.watch, daemon=True).start()
+        atexit.register(self.shutdown)
+
+    def start_worker(self):
+        process = self.context.Process(target=worker, args=(self.queue, self.events, self.dlinfo, self.procinfo))
+        process.start()
+        return process
+
+    # update job status from worker events
+    def collect(self):
+        for event, key, info in iter(self.events.get, None):
+            with self.lock:
+                if event == 'running':
+                    self.jobs[key].update(status='running', **info)
+                    self.jobs[key]['queued_s'] = info['started'] - self.jobs[key]['submitted']
+                    if info['worker'] in self.exited:
+                        # worker died before its event was read
+                        self.jobs[key].update(status='failed', error='worker process exited', finished=time.time())
+                    else:
+                        self.running[info['worker']] = key
+                elif self.jobs[key]['status'] == 'running':
+                    self.running.pop(self.jobs[key]['worker'], None)
+                    self.jobs[key].update(info)
+                    self.jobs[key]['wall_s'] = info['finished'] - self.jobs[key]['started']
+
+    # replace workers which exit while the service runs (e.g. JVM crash), their running job fails
+    def watch(self):
+        while not self.closing:
+            sentinels = {process.sentinel: process for process in self.workers}
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=1):
+                process = sentinels[sentinel]
+                with self.lock:
+                    if self.closing:
+                        return
+                    self.exited.add(process.pid)
+                    job_id = self.running.pop(process.pid, None)
+                    if job_id is not None:
+                        self.jobs[job_id].update(status='failed', finished=time.time(),
+                                                 error='worker process exited with code %s' % process.exitcode)
+                    print('Worker %d exited with code %s, starting a new one.' % (process.pid, process.exitcode), flush=True)
+                    self.workers[self.workers.index(process)] = self.start_worker()
+
+    def submit(self, request):
+        job_id = uuid.uuid4().hex
+        workdir = os.path.join(self.root, job_id)
+        os.makedirs(os.path.join(workdir, 'AOI'))
+        with open(os.path.join(workdir, 'AOI', 'aoi.geojson'), 'w') as f:
+            json.dump(request['aoi'], f)
+        job = {'id'            : job_id,
+               'workdir'       : workdir,
+               'polarisations' : request.get('polarisations', 'VH'),
+               'dlinfo'        : {key: request[key] for key in ['period_start', 'period_stop', 'username', 'password'] if key in request},
+               'procinfo'      : request.get('procinfo', {})}
+        with self.lock:
+            self.jobs[job_id] = {'id': job_id, 'status': 'queued', 'submitted': time.time(), 'error': None}
+        self.queue.put(job)
+        return self.status(job_id)
+
+    def status(self, job_id):
+        with self.lock:
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def outputs(self, job_id):
+        output_path = os.path.join(self.root, job_id, 'output')
+        return sorted(os.path.relpath(os.path.join(root, name), output_path)
+                      for root, dirs, names in os.walk(output_path) for name in names)
+
+    # stop workers after their current job, also registered with atexit
+    def shutdown(self):
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+        for process in self.workers:
+            self.queue.put(None)
+        for process in self.workers:
+            process.join()
+        self.events.put(None)
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data, indent=2).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_json({'error': 'not found'}, 404)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if 'aoi' not in request:
+                raise ValueError('missing aoi')
+        except ValueError as e:
+            return self.send_json({'error': 'invalid request: %s' % e}, 400)
+        self.send_json(self.service.submit(request), 202)
+
+    def do_GET(self):
+        parts = [part for part in self.path.split('/') if part]
+        if parts == ['jobs']:
+            with self.service.lock:
+                return self.send_json(sorted(self.service.jobs.values(), key=lambda job: job['submitted']))
+        if len(parts) < 2 or parts[0] != 'jobs' or self.service.status(parts[1]) is None:
+            return self.send_json({'error': 'not found'}, 404)
+        job_id = parts[1]
+        if len(parts) == 2:
+            return self.send_json(self.service.status(job_id))
+        if len(parts) == 3 and parts[2] == 'outputs':
+            return self.send_json(self.service.outputs(job_id))
+        file = os.path.join(self.service.root, job_id, 'output', *parts[3:])
+        # only files listed as outputs can be fetched
+        if parts[2] != 'outputs' or os.path.relpath(file, os.path.join(self.service.root, job_id, 'output')) not in self.service.outputs(job_id):
+            return self.send_json({'error': 'not found'}, 404)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(file)))
+        self.end_headers()
+        with open(file, 'rb') as f:
+            while True:
+                chunk = f.read(1024**2)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Flood mapping service with warm SNAP workers.')
+    parser.add_argument('--workers', type=int, default=2, help='number of warm worker processes')
+    parser.add_argument('--host', default='127.0.0.1', help='address of HTTP API')
+    parser.add_argument('--port', type=int, default=8080, help='port of HTTP API')
+    parser.add_argument('--socket', help='serve API on this Unix socket instead of HTTP port')
+    parser.add_argument('--jobs-dir', default=os.path.join(os.getcwd(), 'jobs'), help='folder for job working directories')
+    args = parser.parse_args(argv)
+
+    from main import dlinfo, procinfo
+    Handler.service = Service(args.jobs_dir, args.workers, dlinfo, procinfo)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        print('Serving on %s with %d workers.' % (args.socket, args.workers), flush=True)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        print('Serving on http://%s:%d with %d workers.' % (args.host, args.port, args.workers), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        Handler.service.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,7 @@
 import ipyleaflet                             # visualization
 import os                                     # data access
 from IPython.display import display           # visualization
-from osgeo import ogr, gdal, osr              # data conversion
+from osgeo import gdal                        # data conversion
 import json                                   # JSON encoder and decoder
 
 def plotdownloadmap(data_json, product_json):
@@ -56,38 +56,43 @@ def plotbasicmap(S1_source, data_json):
     basic_map.add_layer(ipyleaflet.GeoJSON(data = data_json, style = {'color' : 'green'}))        
 
 
-def plotfloodmap(input_name, polarisations, directory, output_extensions):  
-    print('FLOODMAP')
-    # plot results
-    results_map = ipyleaflet.Map(zoom=9, basemap=ipyleaflet.basemaps.OpenStreetMap.Mapnik)    
-    display(results_map)
-    
+# load GeoTIFF band count and flood mask GeoJSON(s) written by writingoutput
+def load_floodmap_data(input_name, polarisations, directory, output_extensions):
     output_path = os.path.join(directory, 'output')
     GeoTIFF_path = os.path.join(output_path, 'GeoTIFF')
     open_image = gdal.Open('%s/%s_%s.tif' % (GeoTIFF_path, os.path.splitext(input_name)[0], output_extensions))
     GeoJSON_path = os.path.join(output_path, 'GeoJSON')
-    
-    if open_image.RasterCount == 1:
 
-        file = '%s/%s_processed_%s.json' % (GeoJSON_path, os.path.splitext(input_name)[0], polarisations)
+    masks = {}
+    if open_image.RasterCount == 1:
+        files = {polarisations: '%s/%s_processed_%s.json' % (GeoJSON_path, os.path.splitext(input_name)[0], polarisations)}
+    else:
+        files = {pol: '%s/%s_processed_%s.json' % (GeoJSON_path, os.path.splitext(input_name)[0], pol) for pol in ['VV', 'VH']}
+    for pol, file in files.items():
         with open(file, 'r') as f:
-            data_json = json.load(f) 
-        mask = ipyleaflet.GeoJSON(data = data_json, name = 'Flood Mask', style = {'color':'blue', 'opacity':'1', 'fillColor':'blue', 'fillOpacity':'1', 'weight':'0.8'})
+            masks[pol] = json.load(f)
+    return masks
+
+
+def plotfloodmap(input_name, polarisations, directory, output_extensions):  
+    print('FLOODMAP')
+    # plot results
+    results_map = ipyleaflet.Map(zoom=9, basemap=ipyleaflet.basemaps.OpenStreetMap.Mapnik)    
+    display(results_map)
+
+    masks = load_floodmap_data(input_name, polarisations, directory, output_extensions)
+    
+    if len(masks) == 1:
+        mask = ipyleaflet.GeoJSON(data = masks[polarisations], name = 'Flood Mask', style = {'color':'blue', 'opacity':'1', 'fillColor':'blue', 'fillOpacity':'1', 'weight':'0.8'})
         results_map.add_layer(mask)
         results_map.center = (mask.data['features'][0]['geometry']['coordinates'][0][0][1],
                               mask.data['features'][0]['geometry']['coordinates'][0][0][0])
     else:
-        file_VV = '%s/%s_processed_VV.json' % (GeoJSON_path, os.path.splitext(input_name)[0])
-        with open(file_VV, 'r') as f_VV:
-            data_json_VV = json.load(f_VV)
-        mask_VV = ipyleaflet.GeoJSON(data = data_json_VV, name = 'Flood Mask: VV', style = {'color':'red', 'opacity':'1', 'fillColor':'red', 'fillOpacity':'1', 'weight':'0.8'})
+        mask_VV = ipyleaflet.GeoJSON(data = masks['VV'], name = 'Flood Mask: VV', style = {'color':'red', 'opacity':'1', 'fillColor':'red', 'fillOpacity':'1', 'weight':'0.8'})
         results_map.add_layer(mask_VV)
         results_map.center = (mask_VV.data['features'][0]['geometry']['coordinates'][0][0][1],
                               mask_VV.data['features'][0]['geometry']['coordinates'][0][0][0])  
-        file_VH = '%s/%s_processed_VH.json' % (GeoJSON_path, os.path.splitext(input_name)[0])
-        with open(file_VH, 'r') as f_VH:
-            data_json_VH = json.load(f_VH)
-        mask_VH = ipyleaflet.GeoJSON(data = data_json_VH, name = 'Flood Mask: VH', style = {'color':'blue', 'opacity':'1', 'fillColor':'blue', 'fillOpacity':'1', 'weight':'0.8'})
+        mask_VH = ipyleaflet.GeoJSON(data = masks['VH'], name = 'Flood Mask: VH', style = {'color':'blue', 'opacity':'1', 'fillColor':'blue', 'fillOpacity':'1', 'weight':'0.8'})
         results_map.add_layer(mask_VH)
     results_map.add_control(ipyleaflet.FullScreenControl())
     results_map.add_control(ipyleaflet.LayersControl(position='topright'))
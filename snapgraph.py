@@ -0,0 +1,112 @@
+import os                                     # data access
+import time                                   # time assessment
+import xml.etree.ElementTree as ET            # graph XML generation
+import snappy                                 # SNAP Python interface
+import jpy                                    # Python-Java bridge
+from processing import operator_parameters
+from cache import cache_key
+
+# processing chain from subset to terrain correction, in order of execution
+# operators without an entry in the parameters are skipped, e.g. Multilook outside of the quicklook chain
+chain_operators = ['Apply-Orbit-File', 'ThermalNoiseRemoval', 'Calibration', 'Multilook', 'Speckle-Filter', 'LinearToFromdB', 'Terrain-Correction']
+
+# source: node id or list of node ids for operators with several source products
+def add_node(graph, node_id, operator, source, parameters):
+    node = ET.SubElement(graph, 'node', id=node_id)
+    ET.SubElement(node, 'operator').text = operator
+    sources = ET.SubElement(node, 'sources')
+    if source:
+        for i, refid in enumerate([source] if isinstance(source, str) else source):
+            ET.SubElement(sources, 'sourceProduct' if i == 0 else 'sourceProduct.%d' % i, refid=refid)
+    node_parameters = ET.SubElement(node, 'parameters')
+    for key, value in parameters.items():
+        # SNAP expects lower case booleans
+        if isinstance(value, bool):
+            value = str(value).lower()
+        ET.SubElement(node_parameters, key).text = str(value)
+    return(node_id)
+
+# compile subset -> ... -> terrain correction into one SNAP graph
+# the dB product (used for thresholds) and the terrain corrected product are both written,
+# so the shared upstream operators are only computed once
+# input_file: product file or list of consecutive slices of one pass, which are assembled first
+# parameters: operator parameters, default operator_parameters (see processing.quicklook_parameters)
+def build_chain_graph(input_file, footprint, sourceBands, Spk_db_file, TC_file, parameters=None):
+    if parameters is None:
+        parameters = operator_parameters
+    graph = ET.Element('graph', id='mapflood')
+    ET.SubElement(graph, 'version').text = '1.0'
+    input_files = [input_file] if isinstance(input_file, str) else input_file
+    sources = [add_node(graph, 'Read' if i == 0 else 'Read(%d)' % (i + 1), 'Read', None, {'file': file})
+               for i, file in enumerate(input_files)]
+    if len(sources) > 1:
+        source = add_node(graph, 'SliceAssembly', 'SliceAssembly', sources, {})
+    else:
+        source = sources[0]
+    source = add_node(graph, 'Subset', 'Subset', source, {'copyMetadata': True,
+                                                          'geoRegion': footprint,
+                                                          'sourceBands': sourceBands})
+    for operator in chain_operators:
+        if operator not in parameters:
+            continue
+        source = add_node(graph, operator, operator, source, parameters[operator])
+        if operator == 'LinearToFromdB':
+            add_node(graph, 'Write-Spk-db', 'Write', source, {'file': Spk_db_file, 'formatName': 'BEAM-DIMAP'})
+    add_node(graph, 'Write-TC', 'Write', source, {'file': TC_file, 'formatName': 'BEAM-DIMAP'})
+    return(ET.ElementTree(graph))
+
+def execute_graph(graph_file):
+    GraphIO = jpy.get_type('org.esa.snap.core.gpf.graph.GraphIO')
+    GraphProcessor = jpy.get_type('org.esa.snap.core.gpf.graph.GraphProcessor')
+    FileReader = jpy.get_type('java.io.FileReader')
+    ProgressMonitor = jpy.get_type('com.bc.ceres.core.ProgressMonitor')
+    reader = FileReader(graph_file)
+    try:
+        graph = GraphIO.read(reader)
+    finally:
+        reader.close()
+    GraphProcessor().executeGraph(graph, ProgressMonitor.NULL)
+
+# files of materialised dB and terrain corrected products and of the graph itself
+def chain_graph_files(input_file, intermediate_path):
+    if not isinstance(input_file, str):
+        input_file = input_file[0]
+    name = os.path.splitext(os.path.basename(input_file))[0]
+    return(os.path.join(intermediate_path, '%s_Spk_dB.dim' % name),
+           os.path.join(intermediate_path, '%s_TC.dim' % name),
+           os.path.join(intermediate_path, '%s_graph.xml' % name))
+
+# run whole chain once and return materialised dB and terrain corrected products
+def run_chain_graph(input_file, footprint, sourceBands, intermediate_path, parameters=None):
+    print('1.-5. Single-Pass Graph:      ', end='', flush=True)
+    start_time = time.time()
+    if not os.path.isdir(intermediate_path):
+        os.makedirs(intermediate_path)
+    Spk_db_file, TC_file, graph_file = chain_graph_files(input_file, intermediate_path)
+    build_chain_graph(input_file, footprint, sourceBands, Spk_db_file, TC_file, parameters).write(graph_file)
+    execute_graph(graph_file)
+    S1_Spk_db = snappy.ProductIO.readProduct(Spk_db_file)
+    S1_TC = snappy.ProductIO.readProduct(TC_file)
+    print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
+    return(S1_Spk_db, S1_TC)
+
+# key of chain intermediates: product, AOI footprint, bands and all operator parameters
+def chain_cache_key(product_id, footprint, sourceBands, parameters=None):
+    return(cache_key('chain', product_id, footprint, sourceBands, operator_parameters if parameters is None else parameters))
+
+# like run_chain_graph, but dB and terrain corrected products are taken from / stored in cache
+def run_cached_chain_graph(input_file, footprint, sourceBands, intermediate_path, cache=None, key=None, parameters=None):
+    if cache is None:
+        return(run_chain_graph(input_file, footprint, sourceBands, intermediate_path, parameters))
+    entry = cache.get(key)
+    if entry is None:
+        run_chain_graph(input_file, footprint, sourceBands, intermediate_path, parameters)
+        Spk_db_file, TC_file, graph_file = chain_graph_files(input_file, intermediate_path)
+        # BEAM-DIMAP products consist of the .dim header and the .data folder
+        # they are moved into the cache and read from there, a later run rewriting the intermediate files cannot alter the entry
+        entry = cache.put(key, [Spk_db_file, os.path.splitext(Spk_db_file)[0] + '.data', TC_file, os.path.splitext(TC_file)[0] + '.data'],
+                          input_file=input_file)
+    else:
+        print('1.-5. Single-Pass Graph:      --- restored from cache ---', flush=True)
+    Spk_db_file, TC_file, graph_file = chain_graph_files(input_file, entry)
+    return(snappy.ProductIO.readProduct(Spk_db_file), snappy.ProductIO.readProduct(TC_file))
@@ -0,0 +1,59 @@
+import os
+import sys
+from datetime import datetime, date
+import pytest
+
+pytest.importorskip('osgeo')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from catalog import Catalog, missing_intervals
+
+FILTERS = '{"platformname": "Sentinel-1", "producttype": "GRD"}'
+AOI = 'POLYGON((10.2 50.2, 10.4 50.2, 10.4 50.4, 10.2 50.4, 10.2 50.2))'
+
+def product(title, footprint, begin, ingestion):
+    return {'title': title, 'footprint': footprint, 'beginposition': begin, 'ingestiondate': ingestion, 'size': '1.2 GB'}
+
+# offline fixture: products as SentinelAPI.query returns them, one of them far away from the AOI
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / 'cache' / 'catalog.sqlite'))
+    catalog.store({
+        'late'    : product('S1A_late', 'POLYGON((10 50, 11 50, 11 51, 10 51, 10 50))',
+                            datetime(2022, 1, 20, 5, 30), datetime(2022, 1, 20, 9, 0)),
+        'early'   : product('S1A_early', 'POLYGON((9.5 49.5, 10.5 49.5, 10.5 50.5, 9.5 50.5, 9.5 49.5))',
+                            datetime(2022, 1, 16, 17, 10), datetime(2022, 1, 16, 20, 0)),
+        'far'     : product('S1A_far', 'POLYGON((30 10, 31 10, 31 11, 30 11, 30 10))',
+                            datetime(2022, 1, 18, 5, 30), datetime(2022, 1, 18, 9, 0)),
+        'outside' : product('S1A_outside', 'POLYGON((10 50, 11 50, 11 51, 10 51, 10 50))',
+                            datetime(2022, 2, 1, 5, 30), datetime(2022, 2, 1, 9, 0))}, FILTERS)
+    catalog.add_coverage((10.0, 11.0, 50.0, 51.0), FILTERS, datetime(2022, 1, 15), datetime(2022, 1, 20))
+    yield catalog
+    catalog.close()
+
+def test_search(catalog):
+    products = catalog.search(AOI, datetime(2022, 1, 15), datetime(2022, 1, 25), FILTERS)
+    # only intersecting products of the period, ordered by ingestion date, properties restored with datetimes
+    assert list(products) == ['early', 'late']
+    assert products['late']['beginposition'] == datetime(2022, 1, 20, 5, 30)
+    assert products['late']['title'] == 'S1A_late'
+    assert not catalog.search(AOI, datetime(2022, 1, 15), datetime(2022, 1, 25), '{}')
+
+def test_missing_ranges(catalog):
+    envelope = (10.2, 10.4, 50.2, 50.4)
+    assert catalog.missing_ranges(envelope, FILTERS, datetime(2022, 1, 15), datetime(2022, 1, 25)) == \
+        [(datetime(2022, 1, 20), datetime(2022, 1, 25))]
+    # coverage of a smaller area does not count for a larger one
+    assert catalog.missing_ranges((9.0, 12.0, 49.0, 52.0), FILTERS, datetime(2022, 1, 15), datetime(2022, 1, 25)) == \
+        [(datetime(2022, 1, 15), datetime(2022, 1, 25))]
+
+def test_offline_query(catalog):
+    # offline the hub is never contacted, so no API object is needed
+    products = catalog.query(None, AOI, (date(2022, 1, 15), date(2022, 1, 25)), offline=True,
+                             platformname='Sentinel-1', producttype='GRD')
+    assert list(products) == ['early', 'late']
+
+def test_missing_intervals():
+    covered = [(3, 5), (1, 2), (4, 7)]
+    assert missing_intervals(covered, 0, 10) == [(0, 1), (2, 3), (7, 10)]
+    assert missing_intervals([(0, 10)], 2, 8) == []
+    assert missing_intervals([], 2, 8) == [(2, 8)]
@@ -0,0 +1,92 @@
+import os
+import sys
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+requests = pytest.importorskip('requests')
+pytest.importorskip('pandas')
+pytest.importorskip('shapely')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import downloadimage
+
+# local stand-in for the hub: serves DATA with range support, records requested ranges
+# and can cut off the response of the range starting at 'interrupt' after half of its bytes
+DATA = os.urandom(256 * 1024)
+
+class RangeHandler(BaseHTTPRequestHandler):
+    ranges = []
+    interrupt = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        start, end = 0, len(DATA) - 1
+        if 'Range' in self.headers:
+            start, end = [int(value) for value in self.headers['Range'].split('=')[1].split('-')]
+            RangeHandler.ranges.append((start, end))
+        body = DATA[start:end + 1]
+        self.send_response(206 if 'Range' in self.headers else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(DATA)))
+        self.end_headers()
+        if start == RangeHandler.interrupt:
+            RangeHandler.interrupt = None
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+@pytest.fixture
+def server(monkeypatch):
+    RangeHandler.ranges = []
+    RangeHandler.interrupt = None
+    # parts of 64 KB instead of 16 MB, so the small file is split
+    split_ranges = downloadimage.split_ranges
+    monkeypatch.setattr(downloadimage, 'split_ranges', lambda size, connections: split_ranges(size, connections, 64 * 1024))
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d/product.zip' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_split_ranges(server, tmp_path):
+    file = str(tmp_path / 'product.zip')
+    downloadimage.download_file(requests.Session(), server, file, md5=hashlib.md5(DATA).hexdigest(), connections=4)
+    with open(file, 'rb') as f:
+        assert f.read() == DATA
+    assert sorted(RangeHandler.ranges) == [(i * 64 * 1024, (i + 1) * 64 * 1024 - 1) for i in range(4)]
+    assert not os.path.exists(file + '.incomplete') and not os.path.exists(file + '.progress.json')
+
+def test_resume_after_interrupted_part(server, tmp_path):
+    file = str(tmp_path / 'product.zip')
+    md5 = hashlib.md5(DATA).hexdigest()
+    RangeHandler.interrupt = 64 * 1024
+    with pytest.raises(IOError):
+        downloadimage.download_file(requests.Session(), server, file, md5=md5, connections=4, retries=1)
+    assert os.path.isfile(file + '.incomplete') and os.path.isfile(file + '.progress.json')
+    RangeHandler.ranges = []
+    downloadimage.download_file(requests.Session(), server, file, md5=md5, connections=4)
+    with open(file, 'rb') as f:
+        assert f.read() == DATA
+    # only the interrupted part is requested again, from the last flushed offset on
+    assert len(RangeHandler.ranges) == 1
+    start, end = RangeHandler.ranges[0]
+    assert 64 * 1024 <= start and end == 128 * 1024 - 1
+
+def test_md5_mismatch(server, tmp_path):
+    file = str(tmp_path / 'product.zip')
+    with pytest.raises(IOError):
+        downloadimage.download_file(requests.Session(), server, file, md5='0' * 32, connections=4)
+    assert not os.path.exists(file)
+    assert not os.path.exists(file + '.incomplete') and not os.path.exists(file + '.progress.json')
@@ -0,0 +1,51 @@
+import os
+import sys
+import pytest
+
+np = pytest.importorskip('numpy')
+skimage_filters = pytest.importorskip('skimage.filters')
+pytest.importorskip('snappy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processing
+
+# 'Band'-like adapter on a NumPy array, read in row blocks like the bands of the raster store (see rasterstore.py)
+class ArrayBand:
+    def __init__(self, data):
+        self.data = data
+
+    def getRasterWidth(self):
+        return self.data.shape[1]
+
+    def getRasterHeight(self):
+        return self.data.shape[0]
+
+    def window(self, y, rows):
+        return self.data[y:y + rows]
+
+# bimodal dB scene: water around -20 dB, land around -8 dB, and some no-data pixels
+@pytest.fixture
+def scene():
+    rng = np.random.default_rng(0)
+    data = rng.normal(-8.0, 2.5, (600, 500)).astype(np.float32)
+    water = rng.random(data.shape) < 0.3
+    data[water] = rng.normal(-20.0, 2.0, water.sum())
+    data[:5, :5] = np.nan
+    return data
+
+def test_thresholds_match_skimage(scene):
+    counts, edges = processing.get_band_histogram(ArrayBand(scene), block_rows=128)
+    values = scene[np.isfinite(scene)]
+    assert counts.sum() == values.size
+    hist = processing.rebin_histogram(counts, edges)
+    # one bin of the 256-bin histogram skimage builds over the raw values
+    bin_width = (values.max() - values.min()) / 256
+    assert abs(skimage_filters.threshold_otsu(hist=hist) - skimage_filters.threshold_otsu(values)) <= bin_width
+    assert abs(skimage_filters.threshold_minimum(hist=hist) - skimage_filters.threshold_minimum(values)) <= bin_width
+    assert -20.0 < processing.getThreshold(ArrayBand(scene), block_rows=128) < -8.0
+
+def test_values_outside_of_range_are_clamped(scene):
+    scene[10, :] = -80.0
+    scene[11, :] = 40.0
+    counts, edges = processing.get_band_histogram(ArrayBand(scene))
+    assert counts.sum() == np.isfinite(scene).sum()
+    assert counts[0] >= scene.shape[1] and counts[-1] >= scene.shape[1]
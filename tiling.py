@@ -0,0 +1,174 @@
+import os                                     # data access
+import json                                   # JSON encoder and decoder
+import math                                   # tile grid computation
+import time                                   # time assessment
+import multiprocessing                        # process pool start method
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor  # one JVM per worker process
+from osgeo import ogr, gdal                   # geometry and mosaicking
+# snappy is imported inside the workers only, after init_worker has set the JVM heap
+
+# rough area of WGS84 geometry in km^2
+def area_km2(geom):
+    minx, maxx, miny, maxy = geom.GetEnvelope()
+    return geom.GetArea() * 111.32 * 110.57 * math.cos(math.radians((miny + maxy) / 2))
+
+def make_box(minx, miny, maxx, maxy):
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in [(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)]:
+        ring.AddPoint_2D(x, y)
+    box = ogr.Geometry(ogr.wkbPolygon)
+    box.AddGeometry(ring)
+    return box
+
+# split AOI footprint (WKT) into grid tiles of at most max_tile_km2 plus overlap_km on each side
+# 'core' is the tile extent without overlap, used to cut the tile masks before mosaicking
+def split_aoi(footprint, max_tile_km2=800, overlap_km=1.0):
+    geom = ogr.CreateGeometryFromWkt(footprint)
+    if area_km2(geom) <= max_tile_km2:
+        return [{'footprint': footprint, 'core': None}]
+    minx, maxx, miny, maxy = geom.GetEnvelope()
+    km_per_deg_x = 111.32 * math.cos(math.radians((miny + maxy) / 2))
+    km_per_deg_y = 110.57
+    tile_km = math.sqrt(max_tile_km2)
+    nx = max(1, math.ceil((maxx - minx) * km_per_deg_x / tile_km))
+    ny = max(1, math.ceil((maxy - miny) * km_per_deg_y / tile_km))
+    dx, dy = (maxx - minx) / nx, (maxy - miny) / ny
+    ox, oy = overlap_km / km_per_deg_x, overlap_km / km_per_deg_y
+    tiles = []
+    for j in range(ny):
+        for i in range(nx):
+            core = (minx + i * dx, miny + j * dy, minx + (i + 1) * dx, miny + (j + 1) * dy)
+            part = geom.Intersection(make_box(core[0] - ox, core[1] - oy, core[2] + ox, core[3] + oy))
+            if part is None or part.IsEmpty():
+                continue
+            # Subset needs a single polygon, concave AOIs can split into several parts
+            tiles.append({'footprint': part.ConvexHull().ExportToWkt(), 'core': core})
+    return tiles
+
+def init_worker(java_max_mem):
+    # picked up by the JVM which snappy starts in this worker process
+    if java_max_mem:
+        os.environ['_JAVA_OPTIONS'] = '-Xmx%s' % java_max_mem
+
+# worker: run chain for tile and return (fixed-range histogram per band, None) or (None, error) if the chain failed
+def tile_histograms(job):
+    from processing import configure_jai, get_band_histograms
+    from snapgraph import run_chain_graph
+    configure_jai(*job['jai'])
+    try:
+        S1_Spk_db, S1_TC = run_chain_graph(job['input_file'], job['footprint'], job['sourceBands'], job['tile_path'], job['parameters'])
+    except RuntimeError as e:
+        # jpy raises Java exceptions (e.g. tile outside of the product) as RuntimeError
+        print('Tile %s skipped: %s' % (job['tile_path'], e), flush=True)
+        return None, str(e)
+    return get_band_histograms([S1_Spk_db.getBandAt(i) for i in range(S1_Spk_db.getNumBands())]), None
+
+# worker: binarize tile with shared thresholds, filter and write tile mask
+def tile_mask(job, thresholds, mask_type, mask_filter=None):
+    import snappy                             # SNAP Python interface
+    from processing import binarization
+    from maskfilter import filter_flood_mask
+    from snapgraph import chain_graph_files
+    from writeoutput import write_cog
+    Spk_db_file, TC_file, graph_file = chain_graph_files(job['input_file'], job['tile_path'])
+    S1_Spk_db = snappy.ProductIO.readProduct(Spk_db_file)
+    S1_TC = snappy.ProductIO.readProduct(TC_file)
+    S1_floodMask = binarization(S1_TC, S1_Spk_db, mask_type, thresholds, job['land_cover'])
+    mask_image = filter_flood_mask(S1_floodMask, mask_filter)
+    file = os.path.join(job['tile_path'], 'mask.tif')
+    write_cog(mask_image, file, overviews=False)
+    return file
+
+# cut tile masks to their cores on a common pixel grid and mosaic them into one GeoTIFF
+# cores are in lon/lat, which matches the default WGS84 output of Terrain-Correction
+# clip: exact AOI (WKT), pixels outside of it are set to 0
+def mosaic_tiles(tiles, tile_masks, output_file, cog=None, clip=None):
+    first = gdal.Open(tile_masks[0])
+    xres, yres = first.GetGeoTransform()[1], -first.GetGeoTransform()[5]
+    first = None
+    cores = []
+    for tile, file in zip(tiles, tile_masks):
+        core_file = '%s_core.tif' % os.path.splitext(file)[0]
+        # aligned pixels make neighbouring cores share the same grid, so there are no seams
+        gdal.Warp(core_file, file, outputBounds=tile['core'], xRes=xres, yRes=yres, targetAlignedPixels=True,
+                  resampleAlg='near', srcNodata=0, dstNodata=0, creationOptions=['TILED=YES', 'COMPRESS=DEFLATE'])
+        cores.append(core_file)
+    vrt_file = '%s.vrt' % os.path.splitext(output_file)[0]
+    vrt = gdal.BuildVRT(vrt_file, cores, srcNodata=0, VRTNodata=0)
+    if clip:
+        # lazy warped VRT on the same grid with the AOI as cutline, evaluated block by block while writing
+        x0, dx, rx, y0, ry, dy = vrt.GetGeoTransform()
+        bounds = (x0, y0 + vrt.RasterYSize * dy, x0 + vrt.RasterXSize * dx, y0)
+        vrt = gdal.Warp('', vrt, format='VRT', outputBounds=bounds, xRes=dx, yRes=-dy, resampleAlg='near',
+                        cutlineWKT=clip, cutlineSRS='EPSG:4326', srcNodata=0, dstNodata=0)
+    if cog is None:
+        gdal.Translate(output_file, vrt, creationOptions=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    else:
+        from writeoutput import cog_options
+        gdal.Translate(output_file, vrt, format='COG', creationOptions=cog_options(**cog))
+    vrt = None
+    os.remove(vrt_file)
+    return output_file
+
+# process AOI tiles in a process pool and write mosaicked flood mask GeoTIFF
+# returns shared thresholds and the tiles whose chain failed, which are gaps in the mosaic; these are also
+# listed in <directory>/output/skipped_tiles.json (see skipped_tiles)
+# aux: DEM and GlobCover files of the local aux-data store covering the whole AOI (see auxdata.aoi_auxdata)
+def map_tiled(input_file, tiles, sourceBands, directory, inputname, output_extensions, procinfo, aux=None, clip=None):
+    from processing import threshold_from_histogram, operator_parameters, external_dem_parameters
+    print('Processing %d AOI tiles:      ' % len(tiles), end='', flush=True)
+    start_time = time.time()
+    gdal.UseExceptions()
+    tile_root = os.path.join(directory, 'intermediate', 'tiles', os.path.splitext(inputname)[0])
+    workers = procinfo.get('tile_workers') or max(1, os.cpu_count() // 4)
+    # JAI threads are shared between worker JVMs
+    parallelism = max(1, (procinfo.get('parallelism') or os.cpu_count()) // workers)
+    parameters = external_dem_parameters(operator_parameters, aux['dem']) if aux else None
+    jobs = [{'input_file'  : input_file,
+             'footprint'   : tile['footprint'],
+             'sourceBands' : sourceBands,
+             'tile_path'   : os.path.join(tile_root, 'tile_%03d' % i),
+             'parameters'  : parameters,
+             'land_cover'  : aux['landcover'] if aux else None,
+             'jai'         : (procinfo.get('tile_cache_mb'), parallelism)} for i, tile in enumerate(tiles)]
+
+    # spawn gives every worker a fresh JVM with its own heap limit
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(procinfo.get('tile_java_max_mem'),)) as pool:
+        histograms, errors = zip(*pool.map(tile_histograms, jobs))
+        keep = [i for i, histogram in enumerate(histograms) if histogram is not None]
+        if not keep:
+            raise RuntimeError('None of the AOI tiles could be processed.')
+        # thresholds from the summed histograms of all tiles, so the mosaic is consistent
+        thresholds = []
+        for band in range(len(histograms[keep[0]])):
+            counts = sum(histograms[i][band][0] for i in keep)
+            thresholds.append(threshold_from_histogram(counts, histograms[keep[0]][band][1]))
+        tile_masks = list(pool.map(tile_mask, [jobs[i] for i in keep], repeat(thresholds), repeat(procinfo.get('mask_type', 'uint8')),
+                                     repeat(procinfo.get('mask_filter'))))
+
+    GeoTIFF_path = os.path.join(directory, 'output', 'GeoTIFF')
+    output_file = '%s/%s_%s.tif' % (GeoTIFF_path, os.path.splitext(inputname)[0], output_extensions)
+    mosaic_tiles([tiles[i] for i in keep], tile_masks, output_file, procinfo.get('cog'), clip)
+    print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
+
+    skipped = [{'tile': os.path.basename(jobs[i]['tile_path']), 'core': list(tiles[i]['core']), 'error': errors[i]}
+               for i in range(len(tiles)) if errors[i] is not None]
+    report_file = os.path.join(directory, 'output', 'skipped_tiles.json')
+    if skipped:
+        print('Warning: %d of %d AOI tiles failed, the flood mask has gaps at their cores (see %s).'
+              % (len(skipped), len(tiles), report_file), flush=True)
+        with open(report_file, 'w') as f:
+            json.dump(skipped, f, indent=2)
+    elif os.path.isfile(report_file):
+        os.remove(report_file)
+    return thresholds, skipped
+
+# tiles which failed in the last tiled run of working directory, empty if none
+def skipped_tiles(directory):
+    report_file = os.path.join(directory, 'output', 'skipped_tiles.json')
+    if not os.path.isfile(report_file):
+        return []
+    with open(report_file, 'r') as f:
+        return json.load(f)
@@ -1,97 +1,288 @@
 import os                                     # data access
+import json                                   # JSON encoder and decoder
 import time                                   # time assessment
+import numpy as np                            # scientific comupting
 import snappy                                 # SNAP Python interface
+import jpy                                    # Python-Java bridge
 from osgeo import ogr, gdal, osr              # data conversion
-import geopandas                              # data analysis and manipulation
+from concurrent.futures import ThreadPoolExecutor  # parallel format writers
 
-def writingoutput(floodmask, directory, inputname, output_extensions, polarisations):
+# vector output formats: output subfolder name -> (OGR driver, file extension)
+vector_formats = {
+    'SHP'     : ('ESRI Shapefile', 'shp'),
+    'KML'     : ('KML', 'kml'),
+    'GeoJSON' : ('GeoJSON', 'json'),
+    'GPKG'    : ('GPKG', 'gpkg'),
+    'FlatGeobuf' : ('FlatGeobuf', 'fgb')      # with packed R-tree, clients can fetch only the features of an area
+}
+
+# vector tile pyramids: output subfolder name -> (GDAL driver, file extension), PMTiles needs GDAL 3.8
+tile_formats = {
+    'MBTiles' : ('MBTiles', 'mbtiles'),
+    'PMTiles' : ('PMTiles', 'pmtiles')
+}
+
+# formats written by default
+default_formats = ('SHP', 'KML', 'GeoJSON', 'FlatGeobuf', 'MBTiles')
+
+# zoom levels of vector tiles, 14 is about the 10 m pixel size of the flood mask
+tile_zooms = (6, 14)
+
+# simplification tolerance in screen pixels (256 per tile)
+tile_tolerance_px = 0.5
+
+# in-memory uint8 raster which is 1 for flooded pixels of band and 0 elsewhere, filled in row blocks
+# only needed for float32 (1/NaN) masks, uint8 masks are polygonized directly
+def flood_mask_dataset(open_image, band_index, block_rows=1024):
+    input_band = open_image.GetRasterBand(band_index)
+    w, h = input_band.XSize, input_band.YSize
+    mask_image = gdal.GetDriverByName('MEM').Create('', w, h, 1, gdal.GDT_Byte)
+    mask_image.SetGeoTransform(open_image.GetGeoTransform())
+    mask_image.SetProjection(open_image.GetProjectionRef())
+    mask_band = mask_image.GetRasterBand(1)
+    for y in range(0, h, block_rows):
+        rows = min(block_rows, h - y)
+        mask_band.WriteArray((input_band.ReadAsArray(0, y, w, rows) == 1).astype(np.uint8), 0, y)
+    return mask_image
+
+# polygonize only flooded pixels of band straight into an in-memory vector layer
+def polygonize_to_memory(open_image, band_index, layer_name):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(open_image.GetProjectionRef())
+    if open_image.GetRasterBand(band_index).DataType == gdal.GDT_Byte:
+        mask_band = open_image.GetRasterBand(band_index)
+    else:
+        mask_image = flood_mask_dataset(open_image, band_index)
+        mask_band = mask_image.GetRasterBand(1)
+    vector = ogr.GetDriverByName('Memory').CreateDataSource(layer_name)
+    layer = vector.CreateLayer(layer_name, srs=srs, geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('DN', ogr.OFTInteger))
+    # mask band excludes non-flooded pixels, so every polygon has DN = 1
+    gdal.Polygonize(mask_band, mask_band, layer, 0, [], callback=None)
+    return vector
+
+# polygonize band of GeoTIFF through its own dataset handle, so bands can be polygonized in parallel threads
+def polygonize_file(file, band_index, layer_name):
+    return polygonize_to_memory(gdal.Open(file), band_index, layer_name)
+
+# affine geotransform and projection WKT of map-projected 'Product'-type input
+def product_georeference(product):
+    geocoding = product.getSceneGeoCoding()
+    transform = jpy.cast(geocoding.getImageToMapTransform(), jpy.get_type('java.awt.geom.AffineTransform'))
+    geotransform = [transform.getTranslateX(), transform.getScaleX(), transform.getShearX(),
+                    transform.getTranslateY(), transform.getShearY(), transform.getScaleY()]
+    return geotransform, geocoding.getMapCRS().toWKT()
+
+# read flood mask 'Product'-type input in row blocks into in-memory uint8 dataset (1 byte per pixel)
+# with 1 for flooded pixels and 0 as no-data value, works for uint8 (1/0) and float32 (1/NaN) masks
+def mask_dataset(floodmask, block_rows=1024):
+    w = floodmask.getSceneRasterWidth()
+    h = floodmask.getSceneRasterHeight()
+    geotransform, projection = product_georeference(floodmask)
+    mask_image = gdal.GetDriverByName('MEM').Create('', w, h, floodmask.getNumBands(), gdal.GDT_Byte)
+    mask_image.SetGeoTransform(geotransform)
+    mask_image.SetProjection(projection)
+    band_data = np.zeros(w * block_rows, np.float32)
+    for i in range(floodmask.getNumBands()):
+        S1_band = floodmask.getBandAt(i)
+        mask_band = mask_image.GetRasterBand(i + 1)
+        mask_band.SetNoDataValue(0)
+        mask_band.SetDescription(S1_band.getName())
+        for y in range(0, h, block_rows):
+            rows = min(block_rows, h - y)
+            if rows * w != band_data.size:
+                band_data = np.zeros(w * rows, np.float32)
+            S1_band.readPixels(0, y, w, rows, band_data)
+            # works for uint8 (1/0) and float32 (1/NaN) masks
+            mask_band.WriteArray((band_data == 1).astype(np.uint8).reshape(rows, w), 0, y)
+    return mask_image
+
+# write flood mask as tiled, compressed Cloud Optimized GeoTIFF with overviews
+# floodmask: 'Product'-type input, staged in memory first so the file is written in a single pass,
+# or in-memory uint8 dataset e.g. of maskfilter.filter_flood_mask
+def write_cog(floodmask, file, compress='DEFLATE', blocksize=512, overviews=True, block_rows=1024):
+    mask_image = floodmask if isinstance(floodmask, gdal.Dataset) else mask_dataset(floodmask, block_rows)
+    gdal.GetDriverByName('COG').CreateCopy(file, mask_image, options=cog_options(compress, blocksize, overviews))
+    return file
+
+def cog_options(compress='DEFLATE', blocksize=512, overviews=True):
+    return ['COMPRESS=%s' % compress,
+            'BLOCKSIZE=%d' % blocksize,
+            'OVERVIEWS=%s' % ('AUTO' if overviews else 'NONE'),
+            'RESAMPLING=NEAREST',
+            'NUM_THREADS=ALL_CPUS',
+            'BIGTIFF=IF_SAFER']
+
+# vector: dataset or path, writers given a path open their own read-only handle
+def write_vector(vector, file, driver):
+    # the vector drivers do not overwrite existing files, the driver also removes the sidecar files of shapefiles
+    if os.path.exists(file):
+        ogr.GetDriverByName(driver).DeleteDataSource(file)
+    ds = gdal.VectorTranslate(file, vector, format=driver)
+    del ds
+    return file
+
+# write in-memory polygon layer once as FlatGeobuf to /vsimem/, so parallel writers can each open it read-only
+# instead of working on full copies; the layer keeps its name, remove it with gdal.Unlink when done
+def shared_source(vector, layer_name):
+    path = '/vsimem/%s.fgb' % layer_name
+    ds = gdal.VectorTranslate(path, vector, format='FlatGeobuf', layerName=layer_name, layerCreationOptions=['SPATIAL_INDEX=NO'])
+    del ds
+    return path
+
+# union of all flood polygons of the layer at path (see shared_source) and its spatial reference
+# neighbouring polygons merge, so no edge is shared between separate geometries any more
+def dissolve_vector(path):
+    vector = ogr.Open(path)
+    source = vector.GetLayer(0)
+    polygons = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feature in source:
+        polygons.AddGeometry(feature.GetGeometryRef())
+    if polygons.IsEmpty():
+        return polygons, source.GetSpatialRef()
+    return polygons.UnionCascaded(), source.GetSpatialRef()
+
+# polygon layer of dissolved geometry simplified to tolerance (layer units), one feature per polygon
+# the whole coverage is simplified as one geometry: SimplifyPreserveTopology keeps it valid, i.e. rings neither
+# collapse nor cross each other, and islands stay inside the holes that contain them
+def simplify_vector(geometry, srs, layer_name, tolerance):
+    simplified = ogr.GetDriverByName('Memory').CreateDataSource(layer_name)
+    layer = simplified.CreateLayer(layer_name, srs=srs, geom_type=ogr.wkbMultiPolygon)
+    layer.CreateField(ogr.FieldDefn('DN', ogr.OFTInteger))
+    geom = ogr.ForceToMultiPolygon(geometry.SimplifyPreserveTopology(tolerance))
+    for i in range(geom.GetGeometryCount()):
+        polygon = geom.GetGeometryRef(i)
+        if polygon.IsEmpty():
+            continue
+        target = ogr.Feature(layer.GetLayerDefn())
+        target.SetField('DN', 1)
+        target.SetGeometry(ogr.ForceToMultiPolygon(polygon))
+        layer.CreateFeature(target)
+    return simplified
+
+# write vector tile pyramid of the flood polygons of every polarisation
+# each zoom level gets geometries simplified to its resolution, the layers of all zoom levels are published
+# under one tile layer name per polarisation, so clients fetch only the detail of the zoom they show
+# sources: polarisation -> path of polygon layer (see shared_source), dissolved once per polarisation
+def write_vector_tiles(sources, file, driver, zooms=tile_zooms):
+    levels = [(pol, zoom) for pol in sources for zoom in range(zooms[0], zooms[1] + 1)]
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        coverages = dict(zip(sources, executor.map(dissolve_vector, sources.values())))
+    # tolerance in degrees of the WGS84 flood polygons, every thread simplifies its own copy of the coverage
+    jobs = [(pol, '%s_z%d' % (pol, zoom), tile_tolerance_px * 360.0 / (256 * 2**zoom)) for pol, zoom in levels]
+    with ThreadPoolExecutor(max_workers=min(len(jobs), os.cpu_count())) as executor:
+        layers = list(executor.map(lambda job: simplify_vector(coverages[job[0]][0].Clone(), coverages[job[0]][1], job[1], job[2]), jobs))
+    combined = ogr.GetDriverByName('Memory').CreateDataSource('tiles')
+    for simplified in layers:
+        combined.CopyLayer(simplified.GetLayer(0), simplified.GetLayer(0).GetName())
+    conf = {'%s_z%d' % (pol, zoom): {'target_name': 'flood_%s' % pol, 'minzoom': zoom, 'maxzoom': zoom} for pol, zoom in levels}
+    # driver reprojects to Web Mercator and splits the layers into tiles
+    ds = gdal.VectorTranslate(file, combined, format=driver,
+                              datasetCreationOptions=['MINZOOM=%d' % zooms[0], 'MAXZOOM=%d' % zooms[1], 'CONF=%s' % json.dumps(conf)])
+    del ds
+    return file
+
+# floodmask: 'Product'-type input or in-memory uint8 dataset (see maskfilter.filter_flood_mask)
+# cog: None writes a plain GeoTIFF (SNAP's striped GeoTIFF for products), or dict with 'compress' (DEFLATE, ZSTD, LZW), 'blocksize' and 'overviews'
+# formats: keys of vector_formats and tile_formats
+def writingoutput(floodmask, directory, inputname, output_extensions, polarisations, formats=default_formats, cog=None):
 
     print('Exporting...\n', flush=True)
-    # check if output folders exists, if not create folders
-    output_path = os.path.join(directory, 'output')
-    if not os.path.isdir(output_path):
-        os.mkdir(output_path)
+    output_path = make_output_folders(directory, formats)
     GeoTIFF_path = os.path.join(output_path, 'GeoTIFF')
-    if not os.path.isdir(GeoTIFF_path):
-        os.mkdir(GeoTIFF_path)
-    SHP_path = os.path.join(output_path, 'SHP')
-    if not os.path.isdir(SHP_path):
-        os.mkdir(SHP_path)
-    KML_path = os.path.join(output_path, 'KML')
-    if not os.path.isdir(KML_path):
-        os.mkdir(KML_path)
-    GeoJSON_path = os.path.join(output_path, 'GeoJSON')
-    if not os.path.isdir(GeoJSON_path):
-        os.mkdir(GeoJSON_path)
+    name = os.path.splitext(inputname)[0]
 
     # write output file as GeoTIFF
     print('1. GeoTIFF:                   ', end='', flush=True)
     start_time = time.time()
-    snappy.ProductIO.writeProduct(floodmask, '%s/%s_%s' % (GeoTIFF_path, os.path.splitext(inputname)[0], output_extensions), 'GeoTIFF')
-    print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
-    # convert GeoTIFF to SHP
-    print('2. SHP:                       ', end='', flush=True)
-    start_time = time.time()
     # allow GDAL to throw Python exceptions
     gdal.UseExceptions()
-    open_image = gdal.Open('%s/%s_%s.tif' % (GeoTIFF_path, os.path.splitext(inputname)[0], output_extensions))
-    srs = osr.SpatialReference()
-    srs.ImportFromWkt(open_image.GetProjectionRef())
-    shp_driver = ogr.GetDriverByName('ESRI Shapefile')
-    # empty string array for bands in GeoTIFF
-    output_shp = ['' for i in range(open_image.RasterCount)]
-    if open_image.RasterCount == 1:
-        output_shp[0] = '%s/%s_processed_%s' % (SHP_path, os.path.splitext(inputname)[0], polarisations)
+    if cog is None and isinstance(floodmask, gdal.Dataset):
+        gdal.GetDriverByName('GTiff').CreateCopy('%s/%s_%s.tif' % (GeoTIFF_path, name, output_extensions), floodmask,
+                                                 options=['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    elif cog is None:
+        snappy.ProductIO.writeProduct(floodmask, '%s/%s_%s' % (GeoTIFF_path, name, output_extensions), 'GeoTIFF')
     else:
-        VH_SHP_path = os.path.join(SHP_path, 'VH')
-        if not os.path.isdir(VH_SHP_path):
-            os.mkdir(VH_SHP_path)
-        VV_SHP_path = os.path.join(SHP_path, 'VV')
-        if not os.path.isdir(VV_SHP_path):
-            os.mkdir(VV_SHP_path)
-        output_shp[0] = '%s/%s_processed_VH' % (VH_SHP_path, os.path.splitext(inputname)[0])
-        output_shp[1] = '%s/%s_processed_VV' % (VV_SHP_path, os.path.splitext(inputname)[0])
-    # loops through bands in GeoTIFF
-    for i in range(open_image.RasterCount):
-        input_band = open_image.GetRasterBand(i+1)
-        output_shapefile = shp_driver.CreateDataSource(output_shp[i] + '.shp')
-        new_shapefile = output_shapefile.CreateLayer(output_shp[i], srs=srs)
-        new_shapefile.CreateField(ogr.FieldDefn('DN', ogr.OFTInteger))
-        gdal.Polygonize(input_band, input_band.GetMaskBand(), new_shapefile, 0, [], callback=None)
-        # filters attributes with values other than 1 (sould be NaN or respective value)
-        new_shapefile.SetAttributeFilter('DN != 1')
-        for feat in new_shapefile:
-            new_shapefile.DeleteFeature(feat.GetFID())
-        new_shapefile.SyncToDisk()
+        write_cog(floodmask, '%s/%s_%s.tif' % (GeoTIFF_path, name, output_extensions), **cog)
     print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
 
-    # convert SHP to KML
-    print('3. KML:                       ', end='', flush=True)
+    write_vectors(directory, inputname, output_extensions, polarisations, formats)
+
+# move files below staging output folder into output folder, replacing files of the same name
+# every file is swapped atomically, so readers see either the old or the new version
+def publish_outputs(staging_path, output_path):
+    for root, dirs, names in os.walk(staging_path):
+        target_path = os.path.join(output_path, os.path.relpath(root, staging_path))
+        os.makedirs(target_path, exist_ok=True)
+        for name in names:
+            os.replace(os.path.join(root, name), os.path.join(target_path, name))
+
+# check if output folders exists, if not create folders
+def make_output_folders(directory, formats):
+    output_path = os.path.join(directory, 'output')
+    for path in [output_path, os.path.join(output_path, 'GeoTIFF')] + [os.path.join(output_path, name) for name in formats]:
+        if not os.path.isdir(path):
+            os.mkdir(path)
+    return output_path
+
+# polygonize flood mask GeoTIFF written by writingoutput (or mosaicked from tiles) and write vector formats
+def write_vectors(directory, inputname, output_extensions, polarisations, formats=default_formats):
+    output_path = os.path.join(directory, 'output')
+    GeoTIFF_path = os.path.join(output_path, 'GeoTIFF')
+    name = os.path.splitext(inputname)[0]
+
+    # polygonize flooded pixels to memory
+    print('2. Polygonize:                ', end='', flush=True)
     start_time = time.time()
-    if open_image.RasterCount == 1:
-        shp_file = gdal.OpenEx('%s/%s_processed_%s.shp' % (SHP_path, os.path.splitext(inputname)[0], polarisations))
-        ds = gdal.VectorTranslate('%s/%s_processed_%s.kml' % (KML_path, os.path.splitext(inputname)[0], polarisations), shp_file, format='KML')
-        del ds
+    # allow GDAL to throw Python exceptions
+    gdal.UseExceptions()
+    mask_file = '%s/%s_%s.tif' % (GeoTIFF_path, name, output_extensions)
+    if gdal.Open(mask_file).RasterCount == 1:
+        band_polarisations = [polarisations]
     else:
-        shp_file_VH = gdal.OpenEx('%s/%s_processed_VH.shp' % (VH_SHP_path, os.path.splitext(inputname)[0]))
-        ds_VH = gdal.VectorTranslate('%s/%s_processed_VH.kml' % (KML_path, os.path.splitext(inputname)[0]), shp_file_VH, format='KML')
-        del ds_VH
-        shp_file_VV = gdal.OpenEx('%s/%s_processed_VV.shp' % (VV_SHP_path, os.path.splitext(inputname)[0]))
-        ds_VV = gdal.VectorTranslate('%s/%s_processed_VV.kml' % (KML_path, os.path.splitext(inputname)[0]), shp_file_VV, format='KML')
-        del ds_VV
+        band_polarisations = ['VH', 'VV']
+    layer_names = ['%s_processed_%s' % (name, pol) for pol in band_polarisations]
+    # both polarisations at the same time, each layer is serialized once and the in-memory copy freed
+    with ThreadPoolExecutor(max_workers=len(band_polarisations)) as executor:
+        polygons = executor.map(lambda i: shared_source(polygonize_file(mask_file, i + 1, layer_names[i]), layer_names[i]),
+                                range(len(band_polarisations)))
+        sources = dict(zip(band_polarisations, polygons))
     print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
 
-    # convert SHP to GeoJSON
-    print('4. GeoJSON:                   ', end='', flush=True)
+    # write all vector formats concurrently from the shared sources
+    print('3. %-27s' % ('%s:' % '/'.join(formats)), end='', flush=True)
     start_time = time.time()
-    if open_image.RasterCount == 1:
-        shp_file = geopandas.read_file('%s/%s_processed_%s.shp' % (SHP_path, os.path.splitext(inputname)[0], polarisations))
-        shp_file.to_file('%s/%s_processed_%s.json' % (GeoJSON_path, os.path.splitext(inputname)[0], polarisations), driver='GeoJSON')
-    else:
-        shp_file_VH = geopandas.read_file('%s/%s_processed_VH.shp' % (VH_SHP_path, os.path.splitext(inputname)[0]))
-        shp_file_VH.to_file('%s/%s_processed_VH.json' % (GeoJSON_path, os.path.splitext(inputname)[0]), driver='GeoJSON')    
-        shp_file_VV = geopandas.read_file('%s/%s_processed_VV.shp' % (VV_SHP_path, os.path.splitext(inputname)[0]))
-        shp_file_VV.to_file('%s/%s_processed_VV.json' % (GeoJSON_path, os.path.splitext(inputname)[0]), driver='GeoJSON')
-    print('--- %.2f seconds ---\n' % (time.time() - start_time), flush=True)
+    jobs = []
+    for pol in sources:
+        for output_format in [name for name in formats if name in vector_formats]:
+            driver, extension = vector_formats[output_format]
+            format_path = os.path.join(output_path, output_format)
+            # shapefiles of both polarisations are stored in separate subfolders
+            if output_format == 'SHP' and len(sources) > 1:
+                format_path = os.path.join(format_path, pol)
+                if not os.path.isdir(format_path):
+                    os.mkdir(format_path)
+            file = '%s/%s_processed_%s.%s' % (format_path, name, pol, extension)
+            # OGR datasources are not thread-safe, so each writer opens its own handle on the shared source
+            jobs.append((sources[pol], file, driver))
+    if jobs:
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            list(executor.map(lambda job: write_vector(*job), jobs))
+    print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
+
+    # vector tile pyramids with simplified geometries per zoom level
+    for output_format in [name for name in formats if name in tile_formats]:
+        print('4. %-27s' % ('%s:' % output_format), end='', flush=True)
+        start_time = time.time()
+        driver, extension = tile_formats[output_format]
+        file = '%s/%s/%s_processed.%s' % (output_path, output_format, name, extension)
+        # the tile drivers do not overwrite existing files
+        if os.path.isfile(file):
+            os.remove(file)
+        write_vector_tiles(sources, file, driver)
+        print('--- %.2f seconds ---' % (time.time() - start_time), flush=True)
+    for source in sources.values():
+        gdal.Unlink(source)
+    print('', flush=True)
     print('Files successfuly stored under %s.\n' % output_path, flush=True)
-    print('Data export done.')
\ No newline at end of file
+    print('Data export done.')